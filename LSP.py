@@ -4,6 +4,9 @@ from gui.panelmanager import MyPanelManager
 from util.container import Container
 from util.controller import MainController
 from util.cache import ImageCache
+from util.thumbnail import ThumbnailPool
+from util.diff import DiffEngine
+from util import watchdog
 
 # todo:增加menu bar
 # todo:file list ctrl面板
@@ -15,12 +18,27 @@ if __name__ == '__main__':
     auiMgr = MyPanelManager(window)
 
     file_container = Container()
-    auiMgr.file_list_panel.set_container(file_container)
 
-    img_cache = ImageCache(None)
+    # 各模块的可调参数，没有给出的项使用模块内的默认值
+    settings = {
+        'cache_budget': 512 * 1024 * 1024,  # 解码后图像缓存的字节上限
+        'decoders': None,  # 各格式的解码后端顺序，例如{'PNG': ['pil']}，或'pil'表示都优先用PIL
+        'diff': True,  # 图像进入缓存时和相邻的图像比较，按G把其它面板裁剪到变化的区域
+        'disk_cache': None,  # 解码结果的磁盘缓存，True使用默认设置，或{'directory': ..., 'budget': ...}
+        'presenter': None,  # 绘制后端，'win32'或'wx'，None时按平台自动选择
+        'thumbnails': True,  # 文件列表中显示缩略图
+        'trace': None,  # 给出文件名时记录翻页各阶段的耗时，关闭程序时写入Chrome trace JSON
+        'watchdog': None,  # 主线程卡住超过多少秒时记录堆栈，例如0.25，写入缓存目录下的stall.log
+    }
+    thumbnails = ThumbnailPool(settings) if settings.get('thumbnails') else None
+    auiMgr.file_list_panel.set_container(file_container, thumbnails)
+    img_cache = ImageCache(settings)
+    diff_engine = DiffEngine(file_container) if settings.get('diff') else None
 
-    main_controller = MainController(file_container, auiMgr.panel_info_list)
+    main_controller = MainController(file_container, auiMgr.panel_info_list, settings)
 
     auiMgr.Update()
     window.Show(True)
+    # 启动过程中的卡顿不算，在进入事件循环前才开始监视
+    stall_watchdog = watchdog.start(settings.get('watchdog'))
     app.MainLoop()
@@ -0,0 +1,157 @@
+import argparse
+import json
+import math
+import zipfile
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+FORMATS = {'jpg': [cv2.IMWRITE_JPEG_QUALITY, 92], 'png': [cv2.IMWRITE_PNG_COMPRESSION, 3],
+           'webp': [cv2.IMWRITE_WEBP_QUALITY, 90]}
+DEFAULT_SIZE = (1600, 2400)  # 常见的竖版CG尺寸(w, h)
+DEFAULT_COUNT = 12  # 每组差分的张数，包括底图
+DEFAULT_MEMBERS = 20000  # 大压缩文件的成员数，用来测试建立和读取索引
+THUMB_WIDTH = 32  # 大压缩文件中每个成员的宽度，只测试索引，图像越小越好
+
+
+def make_base(size, rng):
+    """
+    生成一张类似CG的底图：渐变的背景，大块平涂的色块和抗锯齿的线稿，再加一层平滑的纹理
+    平涂和线稿让压缩率接近真实的插画，而不是噪声或纯色
+    :param size: (w, h)
+    :param rng: np.random.RandomState
+    :return: BGR的numpy数组
+    """
+    w, h = size
+    y = np.linspace(0., 1., h, dtype=np.float32)[:, None, None]
+    top, bottom = rng.randint(80, 255, 3), rng.randint(0, 160, 3)
+    img = (top * (1 - y) + bottom * y).astype(np.uint8).repeat(w, axis=1)
+    for _ in range(24):
+        color = tuple(int(c) for c in rng.randint(0, 255, 3))
+        center = (int(rng.randint(0, w)), int(rng.randint(0, h)))
+        axes = (int(rng.randint(w // 20, w // 4)), int(rng.randint(h // 20, h // 4)))
+        cv2.ellipse(img, center, axes, float(rng.randint(0, 180)), 0, 360, color, -1, cv2.LINE_AA)
+        cv2.ellipse(img, center, axes, float(rng.randint(0, 180)), 0, 360, (20, 20, 20), max(1, w // 600),
+                    cv2.LINE_AA)
+    for _ in range(60):
+        pts = rng.randint(0, max(w, h), (4, 2)).astype(np.int32)
+        pts[:, 0] %= w
+        pts[:, 1] %= h
+        cv2.polylines(img, [pts], False, (30, 30, 30), max(1, w // 800), cv2.LINE_AA)
+    texture = rng.randint(-8, 9, (max(1, h // 16), max(1, w // 16))).astype(np.float32)
+    texture = cv2.resize(texture, (w, h), interpolation=cv2.INTER_LINEAR).astype(np.int16)[:, :, None]
+    return np.clip(img.astype(np.int16) + texture, 0, 255).astype(np.uint8)
+
+
+def make_variant(base, rng, regions=3):
+    """
+    在底图的几个局部区域做小的修改，模拟差分（表情、道具、特效的变化）
+    :param base: 底图
+    :param rng: np.random.RandomState
+    :param regions: 修改的区域数
+    :return: (BGR的numpy数组, [(left, top, right, bottom)]修改过的区域)
+    """
+    img = base.copy()
+    h, w = img.shape[:2]
+    boxes = []
+    for _ in range(regions):
+        rw, rh = int(w * rng.uniform(0.05, 0.15)), int(h * rng.uniform(0.03, 0.1))
+        left, top = int(rng.randint(0, w - rw)), int(rng.randint(0, h - rh))
+        patch = img[top:top + rh, left:left + rw]
+        kind = rng.randint(3)
+        if kind == 0:
+            # 改变颜色，例如脸红
+            tint = rng.randint(-40, 41, 3).astype(np.int16)
+            patch[:] = np.clip(patch.astype(np.int16) + tint, 0, 255).astype(np.uint8)
+        elif kind == 1:
+            # 重画五官一类的小元素
+            for _ in range(3):
+                center = (int(rng.randint(0, rw)), int(rng.randint(0, rh)))
+                axes = (max(1, rw // 8), max(1, rh // 6))
+                color = tuple(int(c) for c in rng.randint(0, 255, 3))
+                cv2.ellipse(patch, center, axes, 0., 0, 360, color, -1, cv2.LINE_AA)
+        else:
+            # 加上线条类的特效
+            for i in range(6):
+                angle = math.pi * i / 6
+                p1 = (rw // 2, rh // 2)
+                p2 = (int(rw / 2 + math.cos(angle) * rw), int(rh / 2 + math.sin(angle) * rh))
+                cv2.line(patch, p1, p2, (255, 255, 255), max(1, w // 500), cv2.LINE_AA)
+        boxes.append((left, top, left + rw, top + rh))
+    return img, boxes
+
+
+def generate(out_dir, count=DEFAULT_COUNT, size=DEFAULT_SIZE, formats=('jpg', 'png', 'webp'), seed=0,
+             members=DEFAULT_MEMBERS):
+    """
+    生成一组差分图像，每种格式一个文件夹，另外打包成zip（压缩）和cbz（不压缩）
+    再生成一个有members个很小的jpg的zip，用来测试成员很多的压缩文件
+    :param out_dir: 输出目录
+    :param count: 张数，包括底图
+    :param size: (w, h)
+    :param formats: 文件夹中使用的格式
+    :param seed: 随机数种子，相同的参数生成相同的图像
+    :param members: 大压缩文件的成员数，0表示不生成
+    :return: dict，各文件夹、压缩文件的路径和每张差分修改过的区域，同时写入manifest.json
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    rng = np.random.RandomState(seed)
+    base = make_base(size, rng)
+    images = [('000_base', base, [])]
+    for i in range(1, count):
+        img, boxes = make_variant(base, rng)
+        images.append(('{:03d}_diff'.format(i), img, boxes))
+    manifest = {'size': list(size), 'count': count, 'seed': seed, 'folders': {}, 'archives': {},
+                'diffs': {name: boxes for name, _, boxes in images}}
+    encoded = {}
+    for fmt in formats:
+        folder = out_dir / fmt
+        folder.mkdir(exist_ok=True)
+        for name, img, _ in images:
+            ok, data = cv2.imencode('.' + fmt, img, FORMATS[fmt])
+            if not ok:
+                raise ValueError('cv2 cannot encode {}'.format(fmt))
+            (folder / (name + '.' + fmt)).write_bytes(data.tobytes())
+            encoded[(name, fmt)] = data.tobytes()
+        manifest['folders'][fmt] = str(folder)
+    # zip里混合jpg和png，按惯例压缩；cbz通常直接存储jpg
+    for suffix, compression, fmts in (('zip', zipfile.ZIP_DEFLATED, ('jpg', 'png')),
+                                      ('cbz', zipfile.ZIP_STORED, ('jpg',))):
+        path = out_dir / ('set.' + suffix)
+        with zipfile.ZipFile(path, 'w', compression) as zf:
+            for name, _, _ in images:
+                for fmt in fmts:
+                    if (name, fmt) in encoded:
+                        zf.writestr('set/{}.{}'.format(name, fmt), encoded[(name, fmt)])
+        manifest['archives'][suffix] = str(path)
+    if members:
+        w, h = size
+        thumb = cv2.resize(base, (THUMB_WIDTH, max(1, h * THUMB_WIDTH // w)), interpolation=cv2.INTER_AREA)
+        data = cv2.imencode('.jpg', thumb, FORMATS['jpg'])[1].tobytes()
+        path = out_dir / 'large.zip'
+        with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for i in range(members):
+                zf.writestr('large/{:05d}.jpg'.format(i), data)
+        manifest['large_archive'] = {'path': str(path), 'members': members}
+    (out_dir / 'manifest.json').write_text(json.dumps(manifest, indent=2))
+    return manifest
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='生成用于测试的差分CG')
+    parser.add_argument('out_dir')
+    parser.add_argument('--count', type=int, default=DEFAULT_COUNT)
+    parser.add_argument('--size', default='{}x{}'.format(*DEFAULT_SIZE), help='宽x高')
+    parser.add_argument('--formats', default=','.join(FORMATS))
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--members', type=int, default=DEFAULT_MEMBERS, help='大压缩文件的成员数，0表示不生成')
+    args = parser.parse_args(argv)
+    size = tuple(int(v) for v in args.size.lower().split('x'))
+    manifest = generate(args.out_dir, args.count, size, args.formats.split(','), args.seed, args.members)
+    print(json.dumps(manifest, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,371 @@
+"""
+不需要显示器的性能测试，在仓库根目录运行：
+    python -m bench.run --output result.json
+    python -m bench.run --compare result.json
+结果为JSON，每一项记录名称、参数和耗时的统计（毫秒），可以和之前的结果对比
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from pathlib import Path
+from threading import Event
+
+import cv2
+import wx
+from pubsub import pub
+
+from bench.generate import generate
+from gui.canvaspanel import PanelInfo
+from util import decoders, diff
+from util.cache import ImageCache, ImageCacheLoadRequest
+from util.canvas import Canvas
+from util.container import CompressedFiLe, Container
+from util.diskcache import cache_dir
+from util.imgloader import ImageLoader
+
+GROUPS = ('decode', 'cache', 'canvas', 'archive', 'diff')
+PANEL_SIZE = (1280, 720)
+PREVIEW_SIZE = [(640, 480)]  # 降低分辨率解码时的目标尺寸
+ZOOM_STEP = 1.1  # 连续放大时每一步的倍率
+
+
+def measure(fn, repeat, warmup=1):
+    """
+    多次调用fn，返回耗时的统计
+    :param fn: 不带参数的函数
+    :param repeat: 计时的次数
+    :param warmup: 开始计时前先调用的次数
+    :return: dict，单位为毫秒
+    """
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append((time.perf_counter() - start) * 1000)
+    return summarize(times)
+
+
+def summarize(times):
+    times = sorted(times)
+    return {'n': len(times),
+            'min': times[0],
+            'median': statistics.median(times),
+            'mean': statistics.mean(times),
+            'p95': times[min(len(times) - 1, int(len(times) * 0.95))],
+            'max': times[-1]}
+
+
+class Suite(object):
+    """
+    各组测试共用的数据和结果
+    """
+
+    def __init__(self, manifest, repeat):
+        self.manifest = manifest
+        self.repeat = repeat
+        self.results = []
+
+    def add(self, group, name, stats, **params):
+        self.results.append(dict(group=group, name=name, params=params, unit='ms', **stats))
+        print('{:8} {:40} median {:9.2f} ms  p95 {:9.2f} ms'.format(group, name, stats['median'], stats['p95']),
+              file=sys.stderr)
+
+    def files(self, fmt):
+        return sorted(Path(self.manifest['folders'][fmt]).iterdir())
+
+    def bench_decode(self):
+        """
+        ImageLoader.load_img，每种格式分别用各个后端解码原图和预览图，数据事先读入内存，不包括磁盘读取
+        """
+        for fmt, folder in self.manifest['folders'].items():
+            data = [path.read_bytes() for path in self.files(fmt)]
+            sniffed = decoders.sniff(data[0])
+            for backend in decoders.BACKENDS:
+                decoders.configure({sniffed: [backend]})
+                for name, target in (('full', None), ('preview', PREVIEW_SIZE)):
+                    it = iter(range(1 << 30))
+
+                    def load():
+                        img = ImageLoader()
+                        img.load_img(data[next(it) % len(data)], target_size=target)
+                        return img
+
+                    img = load()
+                    if img.backend != backend:
+                        # 后端不支持这个格式时退回了其它后端，不记录
+                        continue
+                    self.add('decode', '{}/{}/{}'.format(sniffed, backend, name), measure(load, self.repeat),
+                             format=sniffed, backend=backend, target_size=target, scale=img.scale)
+        decoders.configure(None)
+
+    def bench_cache(self):
+        """
+        ImageCache从发出请求到收到image_loaded的延迟：未命中（解码）、命中内存、命中磁盘缓存（映射原图）
+        结果的回调直接在解码线程中调用，不需要wx.App
+        磁盘缓存默认不存JPEG，命中磁盘缓存的一项改用png
+        """
+        loaded = {}
+        delivered = {}  # key: 最近一次收到的请求
+
+        def on_image_loaded(msg):
+            req = msg[0]
+            delivered[req.key] = req
+            event = loaded.get(req.key)
+            if event is not None:
+                event.set()
+
+        pub.subscribe(on_image_loaded, 'cache.image_loaded')
+        files = self.files('jpg')
+        png = self.files('png')
+        with tempfile.TemporaryDirectory() as disk_dir:
+            cache = ImageCache({'cache_workers': 2, 'disk_cache': {'directory': disk_dir}},
+                               call_after=lambda fn, *args, **kwargs: fn(*args, **kwargs))
+            seq = iter(range(1 << 30))
+
+            def request(path, key):
+                loaded[key] = event = Event()
+                req = ImageCacheLoadRequest(str(path), {}, None, key=key, disk_key=key + (os.path.getsize(path),))
+                pub.sendMessage('cache.load_image', msg=(req,))
+                if not event.wait(60):
+                    raise RuntimeError('cache did not answer for {}'.format(path))
+
+            def miss():
+                # 每次使用新的key，内存和磁盘缓存都不会命中
+                i = next(seq)
+                request(files[i % len(files)], ('miss', i))
+
+            def hit():
+                request(files[0], ('hit',))
+
+            calls = iter(range(1 << 30))
+
+            def disk():
+                pub.sendMessage('cache.flush', msg=None)
+                request(png[1], ('disk',))
+                # 第一次（预热）解码后存入磁盘，之后都应该直接映射
+                backend = delivered[('disk',)].img.backend
+                if next(calls) and backend != 'disk':
+                    raise RuntimeError('{} was decoded by {}, not mapped from the disk cache'.format(png[1], backend))
+
+            self.add('cache', 'miss', measure(miss, self.repeat), workers=2)
+            self.add('cache', 'hit', measure(hit, self.repeat * 10))
+            self.add('cache', 'disk_hit', measure(disk, self.repeat), format='png')
+            pub.sendMessage('program.closed', msg=None)
+            cache.disk = None
+        pub.unsubscribe(on_image_loaded, 'cache.image_loaded')
+
+    def bench_canvas(self):
+        """
+        Canvas.calculate_zoom+zoom，同步渲染，包括绘制前的准备，不包括实际绘制
+        """
+        img = ImageLoader()
+        img.load_img(str(self.files('jpg')[0]))
+        w, h = PANEL_SIZE
+
+        def canvas_for(name, mode):
+            info = PanelInfo(name, mode, PANEL_SIZE)
+            canvas = Canvas(info)
+            canvas.worker = None
+            canvas.calculate_zoom(img, info)
+            canvas.zoom(True)
+            return canvas, info
+
+        for mode in ('FIT_ALL', 'FIT_HEIGHT', 'FIT_WIDTH'):
+            canvas, info = canvas_for('main_canvas', mode)
+            sizes = iter(range(1 << 30))
+
+            def resize():
+                # 面板尺寸来回变化，每次都要重新缩放
+                d = next(sizes) % 2 * 8
+                info.width, info.height = w - d, h - d
+                canvas.calculate_zoom(img, info)
+                canvas.zoom()
+
+            self.add('canvas', 'resize/' + mode, measure(resize, self.repeat), panel=PANEL_SIZE)
+
+        canvas, info = canvas_for('canvas1', 'FIT_ALL')
+        rects = iter(range(1 << 30))
+
+        def crop():
+            # 框选面板中间的一块放大，再恢复
+            canvas.reset()
+            d = next(rects) % 2 * 4
+            info.crop_rect = (w // 3 + d, h // 3, w // 2 + d, h // 2)
+            canvas.calculate_zoom(img, info)
+            canvas.zoom()
+
+        self.add('canvas', 'crop', measure(crop, self.repeat), panel=PANEL_SIZE)
+
+        for name, factors in (('wheel', (1.25, 0.8)), ('wheel_deep', (8., 0.125))):
+            canvas, info = canvas_for('main_canvas', 'FIT_ALL')
+            steps = iter(range(1 << 30))
+
+            def wheel():
+                # 以面板中心为原点放大、缩小交替
+                info.scale_offset *= factors[next(steps) % 2]
+                info.wp = wx.Point(w // 2, h // 2)
+                canvas.calculate_zoom(img, info)
+                canvas.zoom()
+
+            self.add('canvas', name, measure(wheel, self.repeat), panel=PANEL_SIZE, factors=factors)
+
+        # 连续放大时每一步的倍率都不同，不能重用上一步的结果；_fast按交互过程中的快速渲染处理
+        for name, start, interactive in (('zoom_in', 1., False), ('zoom_in_fast', 1., True),
+                                         ('zoom_in_deep', 8., False), ('zoom_in_deep_fast', 8., True)):
+            canvas, info = canvas_for('main_canvas', 'FIT_ALL')
+            info.interactive = interactive
+            steps = iter(range(1 << 30))
+
+            def zoom_in():
+                # 以面板中心为原点每次放大10%，32步后从头开始
+                info.scale_offset = start * ZOOM_STEP ** (next(steps) % 32)
+                info.wp = wx.Point(w // 2, h // 2)
+                canvas.calculate_zoom(img, info)
+                canvas.zoom()
+
+            self.add('canvas', name, measure(zoom_in, self.repeat), panel=PANEL_SIZE, start=start,
+                     step=ZOOM_STEP, fast=interactive)
+
+    def bench_archive(self):
+        """
+        CompressedFiLe第一次打开（建立索引）、再次打开（读取保存的索引）、列出图像和读取全部图像
+        成员很多的压缩文件只测试打开
+        """
+        suffixes = Container().img_supported
+        large = self.manifest.get('large_archive')
+        if large:
+            self._bench_open('large', Path(large['path']), suffixes, members=large['members'])
+        for kind, path in self.manifest['archives'].items():
+            path = Path(path)
+            self._bench_open(kind, path, suffixes)
+            cf = CompressedFiLe(path)
+            names = cf.list_files(suffixes)
+
+            def read_all():
+                for name in names:
+                    cf.read(name)
+
+            def read_parallel():
+                with ThreadPoolExecutor(4) as pool:
+                    list(pool.map(cf.read, names))
+
+            self.add('archive', kind + '/read_all', measure(read_all, self.repeat), members=len(names))
+            self.add('archive', kind + '/read_parallel', measure(read_parallel, self.repeat), members=len(names),
+                     threads=4)
+            cf.close()
+
+    def _bench_open(self, kind, path, suffixes, **extra):
+        def cold():
+            for idx in (cache_dir() / 'archives').glob('*.idx'):
+                idx.unlink()
+            CompressedFiLe(path).list_files(suffixes)
+
+        def warm():
+            CompressedFiLe(path).list_files(suffixes)
+
+        self.add('archive', kind + '/open_cold', measure(cold, self.repeat), **extra)
+        self.add('archive', kind + '/open_warm', measure(warm, self.repeat), **extra)
+
+    def bench_diff(self):
+        """
+        util.diff对相邻差分的比较：缩小（signature）和比较分别计时，同时记录生成时修改的区域有几个被找到
+        """
+        files = self.files('jpg')
+        images = []
+        for path in files[:2]:
+            img = ImageLoader()
+            img.load_img(str(path))
+            images.append(img)
+
+        def sign():
+            images[1].signature = None
+            return diff.signature(images[1])
+
+        a, b = diff.signature(images[0]), sign()
+        # 生成时修改的区域（像素）和比较找到的区域（比例）有重叠就算找到了，颜色变化太小的区域可能找不到
+        changes = diff.compare(a, b)
+        w, h = self.manifest['size']
+        expected = self.manifest['diffs'][files[1].stem]
+        detected = sum(any(box[0] < r * w and l * w < box[2] and box[1] < btm * h and t * h < box[3]
+                           for l, t, r, btm in changes.boxes) for box in expected)
+        self.add('diff', 'signature', measure(sign, self.repeat), size=list(a.shape[1::-1]))
+        self.add('diff', 'compare', measure(lambda: diff.compare(a, b), self.repeat),
+                 regions=len(changes.boxes), detected=detected, expected=len(expected))
+
+
+def compare(old, new):
+    """
+    按名称对比两次结果的中位数
+    :param old: 之前的结果
+    :param new: 这次的结果
+    :return: [(group, name, 之前的中位数, 这次的中位数, 比例)]
+    """
+    before = {(r['group'], r['name']): r['median'] for r in old['results']}
+    rows = []
+    for r in new['results']:
+        key = (r['group'], r['name'])
+        if key in before:
+            rows.append(key + (before[key], r['median'], r['median'] / before[key] if before[key] else None))
+    return rows
+
+
+def environment():
+    return {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'cv2': cv2.__version__,
+            'wx': wx.version()}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='LSP的性能测试，不需要显示器')
+    parser.add_argument('--data', help='测试图像的目录，不存在时生成；默认使用临时目录')
+    parser.add_argument('--count', type=int, default=8, help='生成的差分张数')
+    parser.add_argument('--size', default='1600x2400', help='生成的图像尺寸，宽x高')
+    parser.add_argument('--repeat', type=int, default=10, help='每项计时的次数')
+    parser.add_argument('--groups', default=','.join(GROUPS), help='要运行的测试组')
+    parser.add_argument('--output', help='结果写入的JSON文件，默认输出到stdout')
+    parser.add_argument('--compare', help='之前的结果，打印中位数的变化')
+    args = parser.parse_args(argv)
+    with tempfile.TemporaryDirectory() as tmp:
+        # 压缩文件的索引等写到临时目录，不影响正常使用的缓存
+        os.environ['XDG_CACHE_HOME'] = os.environ['LOCALAPPDATA'] = str(Path(tmp) / 'cache')
+        data = Path(args.data) if args.data else Path(tmp) / 'data'
+        if (data / 'manifest.json').exists():
+            manifest = json.loads((data / 'manifest.json').read_text())
+        else:
+            size = tuple(int(v) for v in args.size.lower().split('x'))
+            manifest = generate(data, args.count, size)
+        suite = Suite(manifest, args.repeat)
+        # 各模块打印的信息不能混进stdout的结果
+        with redirect_stdout(sys.stderr):
+            for group in args.groups.split(','):
+                getattr(suite, 'bench_' + group)()
+    result = {'environment': environment(),
+              'data': {key: manifest[key] for key in ('size', 'count', 'seed')},
+              'repeat': args.repeat,
+              'results': suite.results}
+    text = json.dumps(result, indent=2)
+    if args.output:
+        Path(args.output).write_text(text)
+    else:
+        print(text)
+    if args.compare:
+        old = json.loads(Path(args.compare).read_text())
+        for group, name, before, after, ratio in compare(old, result):
+            print('{:8} {:40} {:9.2f} -> {:9.2f} ms  x{:.2f}'.format(group, name, before, after, ratio or 0),
+                  file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
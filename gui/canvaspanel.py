@@ -1,5 +1,6 @@
 import wx
 from pubsub import pub
+from gui.coalescer import InputCoalescer
 
 
 class PanelInfo(object):
@@ -16,6 +17,7 @@ class PanelInfo(object):
         self.img_offset = wx.Size(0, 0)  # int
         self.scale_offset = 1.
         self.wp = None  # 记录用滚轮放大时的鼠标坐标
+        self.interactive = False  # 正在拖动、滚轮缩放或改变尺寸，画布使用快速渲染
         # self.rotation = 0  # 最后决定不进行记录了，只对单张图片进行旋转，如果整个压缩包里面全是需要旋转的，倒不如重新导一下
         # 对于旋转屏的显示器，直接改显示属性就行了
         self.is_shown = True
@@ -46,6 +48,8 @@ class CanvasPanel(wx.Window):
         self.right_drag_flag = False
         self.has_image = False
         self.tmp_rect = wx.Rect(0, 0, 0, 0)  # 暂存上次视图更新时的右键框选范围
+        # 拖动、滚轮缩放和尺寸变化的消息每帧最多发送一次
+        self.input = InputCoalescer(info.name, self.on_gesture)
 
         self.SetBackgroundColour(wx.Colour(192, 192, 192))
 
@@ -69,6 +73,20 @@ class CanvasPanel(wx.Window):
         self.Bind(wx.EVT_MOUSEWHEEL, self.OnMouseWheel)
 
         pub.subscribe(self.on_refresh, 'main_control.refresh_panel')
+        pub.subscribe(self.on_scroll, 'main_control.scroll_panel')
+        pub.subscribe(self.input.on_program_closed, 'program.closed')
+
+    def send_move(self):
+        pub.sendMessage('panel.move_image', msg=(self.info,))
+
+    def send_zoom(self):
+        pub.sendMessage('zoom_change', msg=(self.info,))
+
+    def on_gesture(self, active):
+        # 连续输入期间快速渲染，停下来后通知画布用高质量重新渲染
+        self.info.interactive = active
+        if not active:
+            pub.sendMessage('panel.gesture_end', msg=(self.info,))
 
     def OnMouseMove(self, evt):
         if not self.has_image:
@@ -83,7 +101,7 @@ class CanvasPanel(wx.Window):
                     self.cp1 = self.cp2
                     self.info.img_offset.x += x_shift
                     self.info.img_offset.y += y_shift
-                    pub.sendMessage('panel.move_image', msg=(self.info,))
+                    self.input.post('move', self.send_move)
 
         if evt.Dragging() and evt.RightIsDown():  # 鼠标右键拖动
             if self.right_drag_flag:
@@ -98,8 +116,17 @@ class CanvasPanel(wx.Window):
                                                    min(self.sp1[1], self.sp2[1]),
                                                    abs(self.sp2[0] - self.sp1[0]),
                                                    abs(self.sp2[1] - self.sp1[1]))
-                    # 求最近两次select_box的并集，减少屏幕dc更新范围
-                    self.Refresh(True, rect=self.tmp_rect.Union(self.info.select_box))
+                    # 只更新新旧两个选框的边，绘制时只重画这几条边下面的图像
+                    self.refresh_box(self.tmp_rect)
+                    self.refresh_box(self.info.select_box)
+
+    def refresh_box(self, box):
+        # 选框四条边所在的细长区域
+        x, y, w, h = box
+        if w <= 0 or h <= 0:
+            return
+        for rect in ((x, y, w, 2), (x, y + h - 2, w, 2), (x, y, 2, h), (x + w - 2, y, 2, h)):
+            self.Refresh(True, rect=wx.Rect(*rect))
 
     def OnLeftDown(self, evt):
         if not self.has_image:
@@ -146,11 +173,13 @@ class CanvasPanel(wx.Window):
             self.ReleaseMouse()
             self.info.select_box = None
             self.SetCursor(wx.Cursor(wx.CURSOR_ARROW))
+            self.input.flush()
             pub.sendMessage('zoom_change', msg=(self.info,))
 
     def OnRightDClick(self, evt):
         if not self.has_image:
             return
+        self.input.flush()
         self.info.reset()
         pub.sendMessage('zoom_reset', msg=(self.info,))
 
@@ -172,6 +201,11 @@ class CanvasPanel(wx.Window):
             self.has_image = True
             self.Refresh()
 
+    def on_scroll(self, msg):
+        info, dx, dy = msg
+        if info.name == self.info.name and self.has_image:
+            self.ScrollWindow(dx, dy)
+
     def OnPaint(self, evt):
         if not self.has_image:
             evt.Skip()
@@ -179,8 +213,8 @@ class CanvasPanel(wx.Window):
         # dc = wx.BufferedPaintDC(self)
         # dc.Clear()
         # pub.sendMessage('panel.paint_canvas', msg=(self.info, dc))
-        handle = self.GetHandle()
-        pub.sendMessage('panel.paint_canvas', msg=(self.info, handle))
+        # 由画布选择的绘制后端决定用窗口句柄还是wx.PaintDC
+        pub.sendMessage('panel.paint_canvas', msg=(self.info, self))
 
     def OnSized(self, evt):
         # 处理面板尺寸变化消息
@@ -189,7 +223,7 @@ class CanvasPanel(wx.Window):
         self.info.width, self.info.height = w, h
         self.info.rect.SetWidth(w)
         self.info.rect.SetHeight(h)
-        pub.sendMessage('zoom_change', msg=(self.info,))
+        self.input.post('zoom', self.send_zoom)
 
     def OnMouseWheel(self, evt):
         if not self.has_image:
@@ -201,11 +235,11 @@ class CanvasPanel(wx.Window):
                 elif evt.GetWheelRotation() > 0:
                     self.info.scale_offset *= 1.1
                 self.info.wp = evt.GetPosition()
-                if 4 < self.info.scale_offset:
-                    self.info.scale_offset = 4
+                if 32 < self.info.scale_offset:
+                    self.info.scale_offset = 32
                 if self.info.scale_offset < 0.5:
                     self.info.scale_offset = 0.5
-                pub.sendMessage('zoom_change', msg=(self.info,))
+                self.input.post('zoom', self.send_zoom)
         else:
             if evt.GetWheelRotation() < 0:
                 pub.sendMessage('container.load_image', msg=(None, 1))
@@ -0,0 +1,115 @@
+import logging
+import math
+import time
+from collections import Counter
+
+import wx
+
+from util import trace
+
+log = logging.getLogger('coalescer')
+log.setLevel(logging.ERROR)
+
+INPUT_RATE = 60  # 每秒最多处理几次连续的输入，和显示器的刷新率一致
+IDLE_DELAY = 0.15  # 最后一个输入之后多少秒算交互结束
+ORDER = ('zoom', 'move')  # 同一帧内的处理顺序，先确定尺寸和缩放，再平移
+
+
+class InputCoalescer(object):
+    """
+    合并连续的鼠标移动、滚轮和尺寸变化事件，每帧最多处理一次
+    面板的状态（偏移、缩放、尺寸）在事件中已经累积到PanelInfo里，合并时只需要发送最后一次消息
+    连续的输入看作一次交互，开始和结束时调用on_gesture
+    """
+
+    def __init__(self, name, on_gesture=None, rate=INPUT_RATE, idle_delay=IDLE_DELAY):
+        """
+        :param name: 面板名，用于日志
+        :param on_gesture: on_gesture(active)，交互开始时为True，停止输入idle_delay秒后为False
+        :param rate: 每秒最多处理的次数
+        :param idle_delay: 秒
+        """
+        self.name = name
+        self.on_gesture = on_gesture
+        self.idle_delay = idle_delay
+        self.active = False
+        self._idle = None  # 交互结束的计时器
+        self.interval = 1. / rate
+        self.pending = {}  # kind: 这一帧要执行的函数
+        self.events = Counter()  # kind: 收到的事件数
+        self.applied = Counter()  # kind: 实际执行的次数
+        self._frame = Counter()  # kind: 这一帧内收到的事件数
+        self._scheduled = False
+        self._last = 0.  # 上一次处理的时间
+
+    def post(self, kind, fn):
+        """
+        记录一个事件，同类的事件在这一帧内只执行最后一个
+        :param kind: 'zoom'或'move'
+        :param fn: 不带参数的函数，一般是发送消息
+        :return:
+        """
+        self.pending[kind] = fn
+        self.events[kind] += 1
+        self._frame[kind] += 1
+        self._touch()
+        if not self._scheduled:
+            self._scheduled = True
+            delay = self._last + self.interval - time.perf_counter()
+            if delay > 0:
+                wx.CallLater(max(1, math.ceil(delay * 1000)), self.flush)
+            else:
+                # 距离上一帧已经足够久，等事件队列中已有的事件处理完再执行
+                wx.CallAfter(self.flush)
+
+    def _touch(self):
+        # 每次输入都重新开始计时
+        ms = max(1, int(self.idle_delay * 1000))
+        if self._idle is None:
+            self._idle = wx.CallLater(ms, self._on_idle)
+        else:
+            self._idle.Start(ms)
+        if not self.active:
+            self.active = True
+            if self.on_gesture is not None:
+                self.on_gesture(True)
+
+    def _on_idle(self):
+        if self.pending:
+            # 还有没处理的输入，先处理完再结束
+            self.flush()
+        self.active = False
+        if self.on_gesture is not None:
+            self.on_gesture(False)
+
+    def flush(self):
+        """
+        执行这一帧合并后的事件，不连续的操作（框选、重置等）之前也要先调用，保证顺序
+        :return:
+        """
+        self._scheduled = False
+        if not self.pending:
+            return
+        self._last = time.perf_counter()
+        pending, self.pending = self.pending, {}
+        frame, self._frame = self._frame, Counter()
+        # 追踪中记录这一帧合并了几个事件
+        with trace.span('input.flush', panel=self.name, events=dict(frame)):
+            for kind in ORDER:
+                fn = pending.get(kind)
+                if fn is not None:
+                    self.applied[kind] += 1
+                    fn()
+
+    def stats(self):
+        """
+        返回各类事件收到和合并掉的次数
+        :return: dict
+        """
+        return {kind: {'events': self.events[kind], 'merged': self.events[kind] - self.applied[kind]}
+                for kind in self.events}
+
+    def on_program_closed(self, msg):
+        # 每次合并的次数已经记录在input.flush的trace里，这里只是汇总
+        if self.events:
+            log.info('{}: input {}'.format(self.name, self.stats()))
@@ -1,8 +1,11 @@
 import wx
+import cv2
+import numpy as np
+from collections import OrderedDict
 from pubsub import pub
 
+THUMB_SLOTS = 512  # wx.ImageList中保留的缩略图个数，超出时替换最久未显示的
 
-# todo:也许会有一天加入thumbnail功能？遥遥无期...
 
 class FileList(wx.ListCtrl):
     def __init__(self, parent):
@@ -10,11 +13,22 @@ class FileList(wx.ListCtrl):
         self.InsertColumn(0, 'Picture List')
         self.container = None
         self._auto_selection = False
+        # 缩略图
+        self.thumbnails = None  # ThumbnailPool
+        self.image_list = None
+        self.slots = OrderedDict()  # key: image_list中的序号，0是占位图
+        self._free = []  # 文件被修改后空出来的序号
+        self._failed = set()  # 无法生成缩略图的key，不再请求
+        self._rows = {}  # 等待缩略图的key: 请求时的行号
+        self._source = None  # 当前的文件夹或压缩文件，改变时之前的请求都作废
+        self._selected = None  # 选中的文件名，换了图像才滚动到它
         self.SetItemCount(0)
         self.Bind(wx.EVT_SIZE, self.OnSize)
         self.Bind(wx.EVT_LIST_ITEM_SELECTED, self.OnItemSelected)
         pub.subscribe(self.on_img_loaded, 'container.load_image')
+        pub.subscribe(self.on_list_changed, 'container.list_changed')
         pub.subscribe(self.on_selection_changed, 'container.update_status_bar')
+        pub.subscribe(self.on_invalidate, 'cache.invalidate')
 
     def OnGetItemText(self, item, column):
         """
@@ -30,6 +44,103 @@ class FileList(wx.ListCtrl):
             else:
                 return ''
 
+    def OnGetItemImage(self, item):
+        """
+        风格使用wx.LC_VIRTUAL时，显示可见行的图标
+        只查表，没有缩略图时先显示占位图，并请求后台生成
+        :param item: 行号
+        :return: image_list中的序号
+        """
+        if self.thumbnails is None or self.container is None:
+            return -1
+        key = self._key(item)
+        if key is None or key in self._failed:
+            return 0
+        slot = self.slots.get(key)
+        if slot is not None:
+            self.slots.move_to_end(key)
+            return slot
+        self._rows[key] = item
+        # 数据库用的磁盘缓存标识需要stat文件，交给后台线程计算
+        self.thumbnails.request(key, self.container.get_source(item), self.on_thumbnail,
+                                self.container.get_disk_key_source(item))
+        return 0
+
+    def _key(self, item):
+        source = (self.container.img_path, self.container.compressed_file)
+        if source != self._source:
+            # 打开了新的文件夹或压缩文件，之前的请求都作废；后台读取目录、目录变化时列表只是增减，不受影响
+            self._source = source
+            self._failed.clear()
+            self._rows.clear()
+            self.thumbnails.clear()
+        return self.container.get_key(item)
+
+    def set_thumbnails(self, thumbnails):
+        """
+        :param thumbnails: ThumbnailPool
+        :return:
+        """
+        self.thumbnails = thumbnails
+        self.image_list = wx.ImageList(thumbnails.size, thumbnails.size)
+        self.image_list.Add(self._bitmap(None))
+        self.SetImageList(self.image_list, wx.IMAGE_LIST_SMALL)
+
+    def on_thumbnail(self, key, thumb):
+        """
+        ThumbnailPool生成缩略图后在主线程中调用，放入image_list并刷新对应的行
+        :param key:
+        :param thumb: BGR的numpy数组，无法生成时为None
+        :return:
+        """
+        row = self._rows.pop(key, None)
+        if self.image_list is None or key in self.slots:
+            return
+        if thumb is None:
+            self._failed.add(key)
+            return
+        bitmap = self._bitmap(thumb)
+        if self._free:
+            slot = self._free.pop()
+            self.image_list.Replace(slot, bitmap)
+        elif len(self.slots) < THUMB_SLOTS:
+            slot = self.image_list.Add(bitmap)
+        else:
+            _, slot = self.slots.popitem(last=False)
+            self.image_list.Replace(slot, bitmap)
+        self.slots[key] = slot
+        if row is not None and (row >= len(self.container.img_list) or self.container.get_key(row) != key):
+            # 列表在这期间增减过，按key重新查找行号
+            row = self.container.index_of(key)
+        if row is not None and row < self.GetItemCount():
+            self.RefreshItem(row)
+
+    def on_invalidate(self, msg):
+        """
+        行的key不随文件内容改变，文件被修改或删除后去掉旧的缩略图，下次显示时重新生成
+        :param msg: (keys,)
+        :return:
+        """
+        for key in msg[0]:
+            self._failed.discard(key)
+            slot = self.slots.pop(key, None)
+            if slot is not None:
+                self._free.append(slot)
+        if self.thumbnails is not None:
+            self.Refresh()
+
+    def _bitmap(self, thumb):
+        # image_list中的图像尺寸必须相同，缩略图居中放在背景色的正方形上
+        size = self.thumbnails.size
+        colour = self.GetBackgroundColour()
+        square = np.empty((size, size, 3), np.uint8)
+        square[:] = (colour.Red(), colour.Green(), colour.Blue())
+        if thumb is not None:
+            h, w = thumb.shape[:2]
+            top, left = (size - h) // 2, (size - w) // 2
+            square[top:top + h, left:left + w] = cv2.cvtColor(thumb, cv2.COLOR_BGR2RGB)
+        return wx.Bitmap.FromBuffer(size, size, square)
+
     def OnSize(self, evt):
         """
         根据窗口尺寸设置列宽
@@ -43,18 +154,30 @@ class FileList(wx.ListCtrl):
             self.SetItemCount(0)
             self.SetItemCount(len(self.container.img_list))
 
+    def on_list_changed(self, msg):
+        """
+        后台读取目录时列表不断变长，只更新行数，保留滚动位置
+        :param msg: (len(img_list),)
+        :return:
+        """
+        self.SetItemCount(msg[0])
+        self.Refresh()
+
     def OnItemSelected(self, evt):
         if not self._auto_selection:  # 不设置此开关会来回发消息
             # print(evt.GetIndex(), 'selected')
             pub.sendMessage('container.load_image', msg=(evt.GetIndex(), 0))
 
     def on_selection_changed(self, msg):
-        idx = msg[0]
+        idx, name = msg[0], msg[2]
         self._auto_selection = True
         try:
             self.SetItemState(idx, wx.LIST_STATE_SELECTED | wx.LIST_STATE_FOCUSED,
                               wx.LIST_STATE_SELECTED | wx.LIST_STATE_FOCUSED)
-            self.EnsureVisible(idx)
+            # 后台读取目录时列表变长、行号移动，不打断用户的滚动
+            if name != self._selected:
+                self._selected = name
+                self.EnsureVisible(idx)
         finally:
             self._auto_selection = False
 
@@ -67,5 +190,12 @@ class FileListPanel(wx.Panel):
         sizer.Add(self.file_list, 1, wx.EXPAND, 0)
         self.SetSizer(sizer)
 
-    def set_container(self, container):
+    def set_container(self, container, thumbnails=None):
+        """
+        :param container:
+        :param thumbnails: ThumbnailPool，给出时在文件名前显示缩略图
+        :return:
+        """
         self.file_list.container = container
+        if thumbnails is not None:
+            self.file_list.set_thumbnails(thumbnails)
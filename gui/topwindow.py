@@ -82,6 +82,8 @@ class MyFrame(wx.Frame):
             pub.sendMessage('frame.rotate_image', msg=(-1,))
         if keycode == 82:  # R
             pub.sendMessage('frame.rotate_image', msg=(1,))
+        if keycode == 71:  # G
+            pub.sendMessage('frame.jump_to_changes', msg=None)
         if keycode == 32 or keycode == 68 or keycode == 316 or keycode == 367:
             pub.sendMessage('container.load_image', msg=(None, 1))
         if keycode == 8 or keycode == 65 or keycode == 314 or keycode == 366:
@@ -92,9 +94,9 @@ class MyFrame(wx.Frame):
         self.ShowFullScreen(self.full_screen)
 
     def on_update_status(self, msg):
-        idx, length, name, path, w, h = msg
+        idx, length, name, path, w, h, decoder = msg
         pos = '  {:>5d}/{:<5d}'.format(idx + 1, length)
-        size = '  {} x {}'.format(w, h)
+        size = '  {} x {}  {}'.format(w, h, decoder)
         self.status_bar.SetStatusText('  '+name, 0)
         self.status_bar.SetStatusText(size, 1)
         self.status_bar.SetStatusText(pos, 2)
@@ -118,11 +120,12 @@ class MyFrame(wx.Frame):
              重置比例    右键双击（每个面板）
              适应尺寸    Ctrl + 中键（每个面板，在适应全部、高度和宽度中轮换）
              旋转图片    (Ctrl +) R|L
+             差分区域    (Ctrl +) G（其它面板依次放大和相邻图像不同的地方）
              恢复面板    (Ctrl +) H
              图像列表    (Ctrl +) F切换隐藏和显示
              面板布局    (Ctrl +) T
   ++++++++++++++++++++++++++++++++++++++++++++++++++++++++
-  键盘操作时关闭中文输入法可不按Ctrl，图片缩放限制为窗口的一半到四倍"""
+  键盘操作时关闭中文输入法可不按Ctrl，图片缩放限制为窗口的一半到三十二倍"""
         licence = """LSP is a free software
 免费的，欢迎来看源码"""
         info = wx.adv.AboutDialogInfo()
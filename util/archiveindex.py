@@ -0,0 +1,129 @@
+import logging
+import os
+import pickle
+from collections import namedtuple
+from pathlib import Path
+
+from util.diskcache import cache_dir, digest
+
+log = logging.getLogger('archiveindex')
+log.setLevel(logging.ERROR)
+
+INDEX_VERSION = 2  # 索引的结构改变时加一，旧的索引自动作废
+INDEX_LIMIT = 1000  # 最多保留的索引文件数，超出时删除最久未打开的
+
+# 压缩文件内的一个文件：解码后的文件名，压缩文件中原始的文件名，大小，压缩后大小，CRC，
+# 本地文件头的偏移(只有zip有)，压缩方式
+Member = namedtuple('Member', ['name', 'raw_name', 'size', 'compress_size', 'crc', 'offset', 'compress_type'])
+
+
+class ArchiveIndex(object):
+    """
+    压缩文件的成员列表，按(路径,大小,修改时间)存到磁盘上，再次打开同一个压缩文件时不用重新解析
+    按列存储，几万个文件的索引也只需要几毫秒就能读入
+    """
+
+    def __init__(self, key, members, solid=False, order=()):
+        """
+        :param key: archive_key的返回值
+        :param members: [Member]，按name排序
+        :param solid: 是否固实压缩的rar
+        :param order: 压缩文件中原来的文件名顺序，顺序解压时使用
+        """
+        self.version = INDEX_VERSION
+        self.key = key
+        self.columns = tuple(zip(*members)) if members else ((),) * len(Member._fields)
+        self.solid = solid
+        self.order = tuple(order)
+        self.lists = {}  # frozenset(后缀名): 按后缀名筛选出的文件名列表
+        self._positions = None
+
+    @property
+    def names(self):
+        return self.columns[0]
+
+    def __len__(self):
+        return len(self.names)
+
+    def member(self, i):
+        """
+        :param i: 序号
+        :return: Member
+        """
+        return Member._make(column[i] for column in self.columns)
+
+    def position(self, name):
+        """
+        :param name: 解码后的文件名
+        :return: 序号，没有时返回None
+        """
+        if self._positions is None:
+            self._positions = {n: i for i, n in enumerate(self.names)}
+        return self._positions.get(name)
+
+    def get(self, name):
+        """
+        :param name: 解码后的文件名
+        :return: Member，没有时返回None
+        """
+        i = self.position(name)
+        return self.member(i) if i is not None else None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_positions'] = None
+        return state
+
+
+def archive_key(path: Path):
+    """
+    :param path: 压缩文件路径
+    :return: (路径,大小,修改时间)
+    """
+    st = path.stat()
+    return str(path), st.st_size, st.st_mtime_ns
+
+
+def _index_path(path: Path):
+    return cache_dir() / 'archives' / (digest(str(path)) + '.idx')
+
+
+def load(path: Path):
+    """
+    读取保存的索引，压缩文件改变过时返回None
+    :param path: 压缩文件路径
+    :return: ArchiveIndex或None
+    """
+    index_path = _index_path(path)
+    try:
+        with open(index_path, 'rb') as f:
+            index = pickle.load(f)
+        if index.version != INDEX_VERSION or index.key != archive_key(path):
+            return None
+        os.utime(index_path)
+        return index
+    except FileNotFoundError:
+        return None
+    except Exception as e:  # 损坏的索引当作没有
+        log.info('{}: {}'.format(index_path, e))
+        return None
+
+
+def save(index: ArchiveIndex):
+    """
+    保存索引，先写临时文件再改名，并删除最久未打开的索引
+    :param index:
+    :return:
+    """
+    index_path = _index_path(Path(index.key[0]))
+    tmp = index_path.with_suffix('.tmp{}'.format(os.getpid()))
+    try:
+        index_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(tmp, 'wb') as f:
+            pickle.dump(index, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, index_path)
+        entries = sorted(os.scandir(index_path.parent), key=lambda entry: entry.stat().st_mtime)
+        for entry in entries[:max(0, len(entries) - INDEX_LIMIT)]:
+            os.remove(entry.path)
+    except OSError as e:
+        log.info('{}: {}'.format(index_path, e))
@@ -2,27 +2,80 @@
 from pubsub import pub
 import wx
 from threading import Thread, Lock, Semaphore
+from itertools import count
+import heapq
 import logging
+import os
 import traceback
-from util.imgloader import ImageLoader
+from util import decoders, trace
+from util.imgloader import ImageLoader, LoadCancelled
+from util.lru import ByteLRU
+from util.diskcache import DiskCache
 from util.canvas import Canvas
 
 log = logging.getLogger('cache')
 log.setLevel(logging.ERROR)
 
+DEFAULT_CACHE_BUDGET = 512 * 1024 * 1024  # 默认缓存解码后图像的字节上限
+DEFAULT_CACHE_WORKERS = max(1, min(4, (os.cpu_count() or 2) - 1))  # 默认解码线程数，给主线程留一个核
+
 
 class ImageCacheLoadRequest(object):
-    def __init__(self, file_name, panels, canvases):
+    def __init__(self, file_name, panels, canvases, key=None, priority=0, generation=0, target_size=None,
+                 disk_key=None):
+        """
+        :param file_name: 文件名，或由container返回的读取压缩文件内图像的函数，调用时传入判断是否取消的函数
+        :param key: 稳定的图像标识，用于缓存查找，不给出时使用file_name
+        :param priority: 越小越先解码，当前显示的图像为0，预读的图像为与当前图像的距离
+        :param generation: 发出请求时的浏览代数，每次翻页加一
+        :param target_size: [(w, h)]，各面板显示所需的尺寸范围，None表示需要原图
+        :param disk_key: 磁盘缓存用的标识，包括文件大小和修改时间等，None时不使用磁盘缓存；
+            也可以是container.get_disk_key_source返回的函数，只在使用磁盘缓存时才在解码线程中调用
+        """
         self.file_name = file_name
+        self.key = key if key is not None else file_name
+        self.priority = priority
+        self.generation = generation
+        self.target_size = target_size
+        self.disk_key = disk_key
+        self.cancelled = False
+        self.stale = False  # 文件在解码期间被修改或删除，结果不能再使用
+        self.queued_at = None  # 追踪用，进入队列和解码完成的时间，见util.trace
+        self.done_at = None
         self.panels = panels
         self.canvases = canvases
         self.img = None
 
-    def __call__(self):
+    def __call__(self, disk=None, call_after=wx.CallAfter):
         # 特殊函数调用方法，会在cache线程中调用，注意，如果直接命中缓存，此函数是不会被调用的
+        # :param disk: DiskCache，给出时先从磁盘缓存映射原图，解码出原图后存入
+        # :param call_after: 把消息交给主线程的函数
+        if self.cancelled:
+            raise LoadCancelled()
         self.img = ImageLoader()
-        pub.sendMessage('busy', msg=(True,))
-        self.img.load_img(self.file_name)
+        call_after(pub.sendMessage, 'busy', msg=(True,))
+        if disk is not None and callable(self.disk_key):
+            # 需要stat文件，放在解码线程中，主线程翻页时不访问磁盘
+            self.disk_key = self.disk_key()
+        if disk is not None and self.disk_key is not None:
+            with trace.span('request.disk_get', self.generation):
+                cached = disk.get(self.disk_key)
+            if cached is not None:
+                content, fmt = cached
+                self.img.load_raw(content, fmt, 'disk')
+                log.info('{}: mapped from disk cache'.format(self.key))
+                return
+        if callable(self.file_name):
+            with trace.span('request.read', self.generation):
+                fp = self.file_name(lambda: self.cancelled)
+        else:
+            fp = self.file_name
+        with trace.span('request.decode', self.generation, reduced=self.target_size is not None):
+            self.img.load_img(fp, cancelled=lambda: self.cancelled, target_size=self.target_size)
+        log.info('{}: {} decoded by {}'.format(self.key, self.img.format, self.img.backend))
+        if disk is not None and self.disk_key is not None and self.img.scale >= 1 and not self.cancelled:
+            with trace.span('request.disk_put', self.generation):
+                disk.put(self.disk_key, self.img.content, self.img.format)
         # self.update_canvases(True)  # 目前来看，可以不放在单独线程
 
     def update_canvases(self, refresh=False):
@@ -37,10 +90,15 @@ class ImageCacheLoadRequest(object):
                 self.canvases[key].zoom(refresh)
                 pub.sendMessage('main_control.refresh_panel', msg=(self.panels[key],))
 
+    def cancel(self):
+        # 由主线程调用，解码线程会在下一个阶段之间放弃
+        self.cancelled = True
+
     def __eq__(self, other):
         if not other:
             return False
-        cont_eq = (self.file_name is other.file_name)
+        # 压缩文件每次返回新的fp，只能用key来判断是否同一张图片
+        cont_eq = (self.key == other.key)
         return cont_eq
 
     def __ne__(self, other):
@@ -48,52 +106,122 @@ class ImageCacheLoadRequest(object):
 
 
 class ImageCache(object):
-    def __init__(self, settings):
-        self.settings = settings
+    """
+    图像缓存，由多个解码线程按优先级处理读取请求，结果通过wx.CallAfter回到主线程
+    """
+
+    def __init__(self, settings, call_after=None):
+        """
+        :param settings: 可调参数，见LSP.py
+        :param call_after: 解码线程把结果交给主线程的函数，默认wx.CallAfter，没有wx.App时（例如bench）可以替换
+        """
+        self.settings = settings if settings is not None else {}
+        self.call_after = call_after if call_after is not None else wx.CallAfter
+        # 各格式使用的解码后端，见util.decoders.configure
+        decoders.configure(self.settings.get('decoders'))
         pub.subscribe(self.on_load_image, 'cache.load_image')
         pub.subscribe(self.on_clear_pending, 'cache.clear_pending')
+        pub.subscribe(self.on_invalidate, 'cache.invalidate')
         pub.subscribe(self.on_flush, 'cache.flush')
         pub.subscribe(self.on_program_closed, 'program.closed')
+        # 优先队列，元素为[priority, -seq, request]，同优先级时后到的请求先处理
         self.queue = []
+        self.queued = {}  # key: 队列中对应的元素，用来去重和调整优先级
+        self.seq = count()
         self.qlock = Lock()
-        self.cache = []
+        self.cache = ByteLRU(self.settings.get('cache_budget', DEFAULT_CACHE_BUDGET))
+        self.disk = self._open_disk_cache(self.settings.get('disk_cache'))
         self.clock = Lock()
         self.semaphore = Semaphore(0)
-        self.thread = Thread(target=self.run)
-        self.thread.setDaemon(True)
-        self.thread.start()
-        self.processing_request = None
+        self.processing = {}  # key: 正在解码的请求
+        self.generation = 0  # 最近一次浏览操作的代数
+        self.closed = False
+        self.threads = []
+        for i in range(self.settings.get('cache_workers', DEFAULT_CACHE_WORKERS)):
+            thread = Thread(target=self.run, name='cache-worker-{}'.format(i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    @staticmethod
+    def _open_disk_cache(config):
+        """
+        :param config: None或False时不使用磁盘缓存；True使用默认设置；
+            dict时为DiskCache的参数，例如{'directory': ..., 'budget': ..., 'skip_formats': [...]}
+        :return: DiskCache或None
+        """
+        if not config:
+            return None
+        try:
+            return DiskCache(**(config if isinstance(config, dict) else {}))
+        except OSError as e:
+            log.error('disk cache disabled: {}'.format(e))
+            return None
 
     def on_load_image(self, msg):
         request = msg[0]
+        with trace.span('cache.load_image', request.generation, key=str(request.key), priority=request.priority):
+            self._load_image(request)
+
+    def _load_image(self, request):
         hit = False
-        # 锁住缓存，如果查找到有的话，直接分发消息
+        # 锁住缓存查找，如果查找到有的话，直接分发消息
+        # 分发要在锁外进行，因为收到消息的一方可能马上发出新的请求
         with self.clock:
-            for req in self.cache:
-                if req == request:
-                    log.debug('main: cache hit')
-                    self.notify_image_loaded(req)
-                    hit = True
+            req = self.cache.get(request.key)
+            if req is not None:
+                # 金字塔是显示时才生成的，命中时重新计算占用的字节数
+                self.cache.put(request.key, req, req.img.nbytes)
+        if req is not None:
+            log.debug('main: cache hit')
+            # 缓存的请求可能是预读时生成的，面板和画布以最新的请求为准
+            req.panels = request.panels
+            if request.canvases is not None:
+                req.canvases = request.canvases
+            self.notify_image_loaded(req)
+            # 缓存的是分辨率不够的预览图时，先显示，同时在后台解码更高的分辨率
+            hit = req.img.satisfies(request.target_size)
         # 如果没有找到，而且接收的消息也不是正在处理的请求，则生成新请求并插入队列
-        if not hit and request != self.processing_request:
+        if not hit:
             log.debug('main: cache miss')
             self._put_request(request)
 
     def on_image_loaded(self, request):
-        # 将缓存进行锁定，超出容量就将末尾去掉
-        # 然后将结果存入缓存的第一项
+        if request.done_at is not None:
+            # 解码完成到主线程处理之间的等待
+            trace.complete('cache.deliver', request.done_at, request.generation)
+        # 解码完成的请求在存入缓存后才移出processing，避免期间重复解码
+        self._done(request)
+        if request.stale:
+            return
+        # 将缓存进行锁定，按解码后的字节数存入，超出预算就淘汰最久未使用的图片
         with self.clock:
-            if len(self.cache) >= 5:  # 5张图片缓存
-                self.cache.pop()
-            self.cache.insert(0, request)
-            # 发消息出去，带有request结果的信息
-            self.notify_image_loaded(request)
+            cached = self.cache.peek(request.key)
+            if cached is not None and cached.img.scale > request.img.scale:
+                # 已经缓存了更高的分辨率，不用预览图替换，改为分发缓存中的结果
+                cached.panels = request.panels
+                if request.canvases is not None:
+                    cached.canvases = request.canvases
+                request = cached
+            else:
+                evicted = self.cache.put(request.key, request, request.img.nbytes)
+                for key, _ in evicted:
+                    log.debug('main: evicted {}'.format(key))
+        # 发消息出去，带有request结果的信息
+        self.notify_image_loaded(request)
 
     def on_flush(self, msg):
         # 清空缓存
         with self.clock:
-            while self.cache:
-                self.cache.pop()
+            self.cache.clear()
+
+    def stats(self):
+        """
+        返回缓存的命中、未命中、淘汰次数及占用字节数，用来调整缓存预算
+        :return: dict
+        """
+        with self.clock:
+            return self.cache.stats()
 
     def notify_image_loaded(self, request):
         pub.sendMessage('cache.image_loaded', msg=(request,))
@@ -102,67 +230,143 @@ class ImageCache(object):
         pub.sendMessage('cache.image_load_error', msg=(request, exception, tb))
 
     def _put_request(self, request):
-        # 锁住队列，在请求队列的头部插入新的请求，并通过释放semaphore来继续run线程
+        # 锁住队列，按优先级插入新的请求，并通过释放semaphore唤醒一个解码线程
         with self.qlock:
-            if request not in self.queue:
-                log.debug('main: inserting request')
-                self.queue.insert(0, request)
-                log.debug('main: releasing...')
-                self.semaphore.release()
+            running = self.processing.get(request.key)
+            if running is not None and not running.cancelled and self._covers(running, request):
+                return
+            entry = self.queued.get(request.key)
+            if entry is not None:
+                if entry[0] <= request.priority and self._covers(entry[2], request):
+                    return
+                # 已在队列中但优先级更高了，或者需要更高的分辨率，原来的元素作废，重新插入
+                request.priority = min(request.priority, entry[0])
+                entry[2] = None
+            log.debug('main: inserting request')
+            request.queued_at = trace.now()
+            entry = [request.priority, -next(self.seq), request]
+            self.queued[request.key] = entry
+            heapq.heappush(self.queue, entry)
+            log.debug('main: releasing...')
+            self.semaphore.release()
 
-    def on_clear_pending(self, msg):
-        # 清空请求队列
+    @staticmethod
+    def _covers(old, new):
+        # 原图请求可以代替任何请求，预览请求不能代替原图请求
+        return old.target_size is None or new.target_size is not None
+
+    def _pop_request(self):
+        # 取出优先级最高的有效请求，作废的元素直接丢弃，队列为空时返回None
         with self.qlock:
             while self.queue:
-                self.queue.pop()
+                req = heapq.heappop(self.queue)[2]
+                if req is not None:
+                    del self.queued[req.key]
+                    self.processing[req.key] = req
+                    return req
+            return None
+
+    def _done(self, request):
+        # 同一个key可能有已取消和新排队的两个请求，只移除自己
+        with self.qlock:
+            if self.processing.get(request.key) is request:
+                del self.processing[request.key]
+
+    def on_clear_pending(self, msg):
+        """
+        清空请求队列，semaphore多出的计数会让解码线程空转一次
+        :param msg: None时清空全部；或(generation, keep)，只保留keep中的key，
+            不再可能显示的排队请求直接丢弃，正在解码的请求在下一个阶段之间放弃
+        :return:
+        """
+        with self.qlock:
+            if msg is None:
+                self.queue.clear()
+                self.queued.clear()
+                return
+            generation, keep = msg
+            self.generation = generation
+            for key in [key for key in self.queued if key not in keep]:
+                self.queued.pop(key)[2] = None
+            for key, req in self.processing.items():
+                if key not in keep:
+                    log.debug('main: cancelling {}'.format(key))
+                    req.cancel()
+
+    def on_invalidate(self, msg):
+        """
+        文件被修改或删除后，只从缓存和队列中去掉对应的图像，正在解码的请求放弃
+        :param msg: (keys,)
+        :return:
+        """
+        keys = msg[0]
+        with self.clock:
+            for key in keys:
+                self.cache.pop(key)
+        with self.qlock:
+            for key in keys:
+                entry = self.queued.pop(key, None)
+                if entry is not None:
+                    entry[2] = None
+                req = self.processing.get(key)
+                if req is not None:
+                    req.stale = True
+                    req.cancel()
+        # 旧的结果都去掉以后再通知，重新读取的请求不会命中过时的缓存
+        pub.sendMessage('cache.invalidated', msg=(keys,))
 
     def on_program_closed(self, msg):
         log.debug('main: on closed')
-        # log.debug('main: clearing pending...')
-        # 直接调用
+        # 直接调用，正在解码的请求也一并放弃
         self.on_clear_pending(None)
-        # 在队列中插入None请求
         with self.qlock:
-            log.debug('main: adding None request')
-            self.queue.insert(-1, None)
+            for req in self.processing.values():
+                req.cancel()
+        self.closed = True
         log.debug('main: releasing...')
-        # 释放semaphore让run线程执行
-        self.semaphore.release()
+        # 释放semaphore让所有解码线程退出
+        for _ in self.threads:
+            self.semaphore.release()
         log.debug('main: joining...')
-        # 等待run线程所有代码执行完毕
-        self.thread.join()
+        # 等待解码线程中正在处理的请求执行完毕
+        for thread in self.threads:
+            thread.join()
+        log.info('main: cache stats {}'.format(self.stats()))
+        log.info('main: decoder stats {}'.format(dict(decoders.stats)))
+        if self.disk is not None:
+            log.info('main: disk cache stats {}'.format(self.disk.stats()))
         print('cache cleared')
 
     def run(self):
         log.debug('thread: running...')
         while True:
             log.debug('thread: acquiring...')
-            # 因为初始计数为0，只有当run即本线程之外有release()调用时才往下执行
+            # 因为初始计数为0，只有当本线程之外有release()调用时才往下执行
             self.semaphore.acquire()
+            # 程序关闭时，结束整个函数，即跳出解码线程
+            if self.closed:
+                return
             log.debug('thread: acquired. reading request...')
-            while True:
-                with self.qlock:
-                    # 如果清空了所有请求，则跳出循环
-                    if not self.queue:
-                        log.debug('thread: queue empty')
-                        break
-                    req = self.queue.pop()
-                # 如果出现了None请求，则结束整个函数，即跳出run线程
-                if req is None:
-                    return
-                self.processing_request = req
-                e, tb = None, None
-                try:
-                    log.debug('thread: running request...')
-                    req()
-                    log.debug('thread: request processed, notifying')
-                    wx.CallAfter(self.on_image_loaded, req)
-                    log.debug('thread: request processed notified')
-                except Exception as e:
-                    tb = traceback.format_exc()
-                    log.debug('thread: request raised an exception')
-                    # log.debug(tb)
-                finally:
-                    self.processing_request = None
-                if tb:
-                    wx.CallAfter(self.notify_image_load_error, req, e, tb)
+            req = self._pop_request()
+            if req is None:
+                log.debug('thread: queue empty')
+                continue
+            error, tb = None, None
+            try:
+                log.debug('thread: running request...')
+                trace.complete('cache.queued', req.queued_at, req.generation)
+                with trace.span('cache.decode', req.generation, key=str(req.key), priority=req.priority):
+                    req(self.disk, self.call_after)
+                req.done_at = trace.now()
+                log.debug('thread: request processed, notifying')
+                self.call_after(self.on_image_loaded, req)
+                log.debug('thread: request processed notified')
+            except LoadCancelled:
+                log.debug('thread: request cancelled')
+                self._done(req)
+            except Exception as e:
+                error, tb = e, traceback.format_exc()
+                log.debug('thread: request raised an exception')
+                self._done(req)
+            if tb:
+                self.call_after(self.notify_image_load_error, req, error, tb)
@@ -1,49 +1,35 @@
-import ctypes
 import logging
-from ctypes import c_ubyte, c_void_p, byref, sizeof
-from ctypes.wintypes import WORD, DWORD, LONG
+import math
+from itertools import count
 
-import win32api
-import win32con
-import win32gui
 import wx
+from pubsub import pub
 
 from gui.canvaspanel import PanelInfo
 from util.imgloader import ImageLoader
+from util import trace
+from util.present import get_presenter
+from util.render import RenderJob, render, get_worker
+from util.tiles import TileRenderer
 
 level = logging.DEBUG
+TILED_THRESHOLD = 4  # 缩放后的图像超过面板面积的几倍时，改为只渲染可见区域的块
 
 
-class RGBQUAD(ctypes.Structure):
-    _fields_ = [
-        ('rgbRed', c_ubyte),
-        ('rgbGreen', c_ubyte),
-        ('rgbBlue', c_ubyte),
-        ('rgbReserved', c_ubyte)
-    ]
-
-
-class BITMAPINFOHEADER(ctypes.Structure):
-    _fields_ = [
-        ('biSize', DWORD),
-        ('biWidth', LONG),
-        ('biHeight', LONG),
-        ('biPlanes', WORD),  # 1
-        ('biBitCount', WORD),  # 24
-        ('biCompression', DWORD),  # BI_RGB = 0 for uncompressed format
-        ('biSizeImage', DWORD),  # 0
-        ('biXPelsPerMeter', LONG),  # 0
-        ('biYPelsPerMeter', LONG),  # 0
-        ('biClrUsed', DWORD),  # 0
-        ('biClrImportant', DWORD)  # 0
-    ]
-
-
-class BITMAPINFO(ctypes.Structure):
-    _fields_ = [
-        ('bmiHeader', BITMAPINFOHEADER),
-        ('bmiColors', RGBQUAD * 256)
-    ]
+def source_box(info: PanelInfo, crop=(0., 0., 1., 1.)):
+    """
+    计算面板按当前裁剪和缩放显示时，需要的源图像尺寸范围
+    :param info:
+    :param crop: 裁剪比例
+    :return: (w, h)，适应宽度或高度时另一边不受限，为inf
+    """
+    w = info.width * info.scale_offset / max(crop[2] - crop[0], 0.01)
+    h = info.height * info.scale_offset / max(crop[3] - crop[1], 0.01)
+    if info.mode == 'FIT_WIDTH':
+        h = math.inf
+    elif info.mode == 'FIT_HEIGHT':
+        w = math.inf
+    return w, h
 
 
 class Canvas(object):
@@ -55,10 +41,16 @@ class Canvas(object):
     def __init__(self, panel_info: PanelInfo):
         self.info = panel_info
         self.img = None
-        self.cropped_img = None
-        self.zoomed_img = None
-        self.bmi = None
-        self.bmp_bits = None
+        self.zoomed_size = (0, 0)  # 裁剪部分缩放后整张图像的尺寸
+        self.tiled = False
+        self.tiles = TileRenderer()  # 只在渲染线程中使用
+        self._view = (0, 0, 0, 0)  # 最近一次提交渲染的范围(left, top, right, bottom)
+        self.frame = None  # 最近一次渲染完成的结果，绘制时只使用它
+        self._fast_pending = False  # 最近一次提交的是否快速渲染，结果可能还在渲染线程中
+        self._shown = None  # (frame, x, y)，屏幕上的结果和它的位置，平移时据此滚动已有的像素
+        self.worker = get_worker()  # 为None时在调用线程中同步渲染
+        self.presenter = get_presenter()
+        self._seq = count()
         self.scale_ratio_old = 1.
         self.scale_ratio = 1.
         self.scale_offset_old = 1.
@@ -91,7 +83,7 @@ class Canvas(object):
                              info.crop_rect[2] - self._left - self.img_offset.x,
                              info.crop_rect[3] - self._top - self.img_offset.y)
                 # 计算目前展示的图片的crop ratio
-                width, height = self.zoomed_img.width, self.zoomed_img.height
+                width, height = self.zoomed_size
                 crop_new = [crop_rect[0] / width, crop_rect[1] / height, crop_rect[2] / width, crop_rect[3] / height]
                 for i in range(len(crop_new)):
                     crop_new[i] = crop_new[i] if crop_new[i] > 0 else 0.
@@ -161,8 +153,8 @@ class Canvas(object):
         # 需要保证缩放比例不能太小和太大，为负数会异常
         if scale_ratio < 0.01:
             scale_ratio = 0.01
-        elif scale_ratio > 16:
-            scale_ratio = 16.
+        elif scale_ratio > 64:  # 分块渲染只处理可见区域，放大倍数不再受内存限制
+            scale_ratio = 64.
         # 原始比例发生变化，或者裁剪发生变化，或者有滚轮缩放的消息
         if (self.scale_ratio != scale_ratio) or (self.crop_old != self.crop) or (
                 self.scale_offset != info.scale_offset):
@@ -177,7 +169,7 @@ class Canvas(object):
 
     def zoom(self, refresh=False):
         """
-        根据self.crop,self.scale_ratio更新self.zoomed_img
+        根据self.crop,self.scale_ratio更新显示位置，并提交渲染
         :param refresh: 是否强制更新
         :return: bool,如果更新返回True
         """
@@ -187,71 +179,150 @@ class Canvas(object):
                 or self.scale_ratio != self.scale_ratio_old \
                 or self.crop != self.crop_old \
                 or self.scale_offset != self.scale_offset_old:
-            self.cropped_img = self.img.crop((int(self.crop[0] * self.img.width),
-                                              int(self.crop[1] * self.img.height),
-                                              int(self.crop[2] * self.img.width),
-                                              int(self.crop[3] * self.img.height)))
-            # print(self.info.name, 'scale:{:.2f},offset:{:.2f},crop_img size:({},{})'.format(self.scale_ratio,
-            #                                                                                 self.scale_offset,
-            #                                                                                 self.cropped_img.width,
-            #                                                                                 self.cropped_img.height))
-            # print('-' * 8, 'self.img.size:({},{})'.format(self.img.width, self.img.height))
-            # print('-' * 8,
-            #       'self.crop:({:.2f},{:.2f},{:.2f},{:.2f})'.format(self.crop[0], self.crop[1], self.crop[2],
-            #                                                        self.crop[3]))
-            # cv2操作的np数组在resize的时候必须4的整数倍，不然出来十分奇怪
-            w = int(self.scale_ratio * self.scale_offset * self.cropped_img.width) // 4 * 4
-            h = int(self.scale_ratio * self.scale_offset * self.cropped_img.height) // 4 * 4
-            # 确保不会缩的太小或小于0
-            w = w if w > 10 else 10
-            h = h if h > 10 else 10
-            self.zoomed_img = self.cropped_img.resize((w, h))
-            # 生成Bitmap的信息结构
-            self.bmi = BITMAPINFO(
-                BITMAPINFOHEADER(sizeof(BITMAPINFOHEADER),
-                                 self.zoomed_img.width,
-                                 self.zoomed_img.height,
-                                 1,
-                                 24,  # 不带alpha通道的24位位图
-                                 0, 0, 0, 0, 0, 0),
-                (RGBQUAD * 256)(*[RGBQUAD(i, i, i, 0) for i in range(256)]))
-            # np数组转换为Bitmap的bits
-            # todo:封装
-            data = self.zoomed_img.content  # .astype(np.uint8) 出bug了再说
-            self.bmp_bits = data.ctypes.data_as(c_void_p)
-            # 判断是否有缩放原点
-            if self.info.wp is None:
-                self._left = (self.info.width - self.zoomed_img.width) // 2
-                self._top = (self.info.height - self.zoomed_img.height) // 2  # 中心对齐，如果顶端对齐设为0
-            else:
-                # print('click:', self.info.wp, 'left top:(', self._left, self._top, ') scale:', (
-                #         self.scale_ratio * self.scale_offset) / (
-                #               self.scale_ratio_old * self.scale_offset_old))
-                self._left = self.info.wp.x - (self.info.wp.x - self.img_offset.x - self._left) * (
-                        self.scale_ratio * self.scale_offset) / (
-                                     self.scale_ratio_old * self.scale_offset_old) - self.img_offset.x
-                self._top = self.info.wp.y - (self.info.wp.y - self.img_offset.y - self._top) * (
-                        self.scale_ratio * self.scale_offset) / (
-                                    self.scale_ratio_old * self.scale_offset_old) - self.img_offset.y
-                self.info.wp = None
-            self.crop_old = self.crop
-            self.scale_ratio_old = self.scale_ratio
-            self.scale_offset_old = self.scale_offset
+            with trace.span('canvas.zoom', panel=self.info.name):
+                self._measure()
+                # 判断是否有缩放原点
+                if self.info.wp is None:
+                    self._left = (self.info.width - self.zoomed_size[0]) // 2
+                    self._top = (self.info.height - self.zoomed_size[1]) // 2  # 中心对齐，如果顶端对齐设为0
+                else:
+                    # print('click:', self.info.wp, 'left top:(', self._left, self._top, ') scale:', (
+                    #         self.scale_ratio * self.scale_offset) / (
+                    #               self.scale_ratio_old * self.scale_offset_old))
+                    self._left = self.info.wp.x - (self.info.wp.x - self.img_offset.x - self._left) * (
+                            self.scale_ratio * self.scale_offset) / (
+                                         self.scale_ratio_old * self.scale_offset_old) - self.img_offset.x
+                    self._top = self.info.wp.y - (self.info.wp.y - self.img_offset.y - self._top) * (
+                            self.scale_ratio * self.scale_offset) / (
+                                        self.scale_ratio_old * self.scale_offset_old) - self.img_offset.y
+                    self.info.wp = None
+                self._refresh_frame()
+                self.crop_old = self.crop
+                self.scale_ratio_old = self.scale_ratio
+                self.scale_offset_old = self.scale_offset
             return True
         else:
             return False
 
+    def _measure(self):
+        """
+        按self.crop,self.scale_ratio,self.scale_offset计算缩放后的尺寸，不改变显示位置
+        :return:
+        """
+        scale = self.scale_ratio * self.scale_offset
+        # cv2操作的np数组在resize的时候必须4的整数倍，不然出来十分奇怪
+        w = int(scale * (int(self.crop[2] * self.img.width) - int(self.crop[0] * self.img.width))) // 4 * 4
+        h = int(scale * (int(self.crop[3] * self.img.height) - int(self.crop[1] * self.img.height))) // 4 * 4
+        # 确保不会缩的太小或小于0
+        w = w if w > 10 else 10
+        h = h if h > 10 else 10
+        self.zoomed_size = (w, h)
+        # 比面板大很多时只渲染可见区域，在确定显示位置后由_update_view生成
+        self.tiled = w * h > TILED_THRESHOLD * self.info.width * self.info.height
+
+    def _refresh_frame(self):
+        """
+        确定显示位置后提交渲染，分块渲染时由_update_view只提交可见区域
+        :return:
+        """
+        if self.tiled:
+            self._view = (0, 0, 0, 0)
+            self._update_view()
+        else:
+            self._view = (0, 0) + self.zoomed_size
+            self._submit()
+
+    def _update_view(self):
+        """
+        分块渲染时，可见区域移出已拼接的范围后，重新拼接覆盖可见区域的块
+        :return:
+        """
+        if not self.tiled:
+            return
+        x = -int(self._left + self.img_offset.x)
+        y = -int(self._top + self.img_offset.y)
+        visible = (max(0, x), max(0, y),
+                   min(self.zoomed_size[0], x + self.info.width), min(self.zoomed_size[1], y + self.info.height))
+        if visible[2] <= visible[0] or visible[3] <= visible[1]:
+            return
+        if self._view[0] <= visible[0] and self._view[1] <= visible[1] \
+                and visible[2] <= self._view[2] and visible[3] <= self._view[3]:
+            return
+        self._view = self.tiles.align(visible, self.zoomed_size)
+        self._submit()
+
+    def _submit(self):
+        """
+        把当前的裁剪、缩放和显示位置打包成渲染任务，交给渲染线程
+        :return:
+        """
+        job = RenderJob(self, next(self._seq), self.img, self.crop, self.scale_ratio * self.scale_offset,
+                        self.zoomed_size, self._view, (self._left, self._top), self.presenter, self.tiled,
+                        trace.get_context(), self.info.interactive)
+        self._fast_pending = job.fast
+        if self.worker is None:
+            self.on_rendered(render(job))
+        else:
+            self.worker.submit(job)
+
+    def on_rendered(self, frame):
+        """
+        在主线程中整体替换要绘制的结果，比已显示的结果更旧的直接丢弃
+        :param frame:
+        :return:
+        """
+        if self.frame is not None and frame.seq < self.frame.seq:
+            return
+        self.frame = frame
+        pub.sendMessage('main_control.refresh_panel', msg=(self.info,))
+
+    def refine(self):
+        """
+        交互结束后，把快速渲染的结果用高质量重新渲染
+        按最近一次提交的任务判断，最后的快速渲染可能在交互结束时还没有完成
+        :return:
+        """
+        if not self._fast_pending or self.img is None or not self.info.is_shown:
+            return
+        self._refresh_frame()
+
+    def set_image(self, img: ImageLoader):
+        """
+        换成同一图像的另一种分辨率（例如预览图解码出原图后），保持裁剪、显示尺寸和位置不变
+        :param img:
+        :return:
+        """
+        ratio = self.img.width / img.width
+        self.scale_ratio *= ratio
+        self.scale_ratio_old *= ratio
+        self.img = img
+        if self.info.is_shown and self.zoomed_size != (0, 0):
+            self._measure()
+            self._refresh_frame()
+
+    def source_box(self):
+        """
+        返回本画布当前需要的源图像尺寸范围
+        :return: (w, h)
+        """
+        return source_box(self.info, self.crop)
+
     def move_image(self, msg):
+        """
+        平移图像
+        :param msg: (panel_info,)
+        :return: (dx, dy)，屏幕上已有的像素可以直接滚动的距离；None表示需要整个重绘
+        """
         if msg is not None:
             info = msg[0]
             self.img_offset = info.img_offset
         # 限制整个图像的位移，公式：实际的横坐标(_left+offset.x)应落在
-        # info.width-max(info.width,zoomed_img.width)与info.width-min(info.width,zoomed_img.width)之间
+        # info.width-max(info.width,zoomed_size[0])与info.width-min(info.width,zoomed_size[0])之间
         real_x, real_y = self._left + self.img_offset.x, self._top + self.img_offset.y
-        left_limit = self.info.width - max(self.info.width, self.zoomed_img.width)
-        right_limit = self.info.width - min(self.info.width, self.zoomed_img.width)
-        top_limit = self.info.height - max(self.info.height, self.zoomed_img.height)
-        bottom_limit = self.info.height - min(self.info.height, self.zoomed_img.height)
+        left_limit = self.info.width - max(self.info.width, self.zoomed_size[0])
+        right_limit = self.info.width - min(self.info.width, self.zoomed_size[0])
+        top_limit = self.info.height - max(self.info.height, self.zoomed_size[1])
+        bottom_limit = self.info.height - min(self.info.height, self.zoomed_size[1])
         if real_x < left_limit:
             self.img_offset.x = left_limit - self._left
         if real_x > right_limit:
@@ -260,6 +331,21 @@ class Canvas(object):
             self.img_offset.y = top_limit - self._top
         if real_y > bottom_limit:
             self.img_offset.y = bottom_limit - self._top
+        # 分块渲染时补上新露出来的块
+        self._update_view()
+        frame = self.frame
+        if self._shown is None or frame is None or self._shown[0] is not frame:
+            return None
+        x, y = self._position(frame)
+        dx, dy = x - self._shown[1], y - self._shown[2]
+        # 滚动后屏幕上的像素已经在新的位置
+        self._shown = (frame, x, y)
+        return dx, dy
+
+    def _position(self, frame):
+        # 结果左上角在面板中的位置
+        return (int(frame.origin[0] + self.img_offset.x) + frame.view[0],
+                int(frame.origin[1] + self.img_offset.y) + frame.view[1])
 
     def reset(self, img=None):
         """
@@ -284,59 +370,20 @@ class Canvas(object):
 
     def paint_canvas(self, msg):
         """
-        通过window handle对画布进行更新
-        :param msg: (panel_info,hwnd)
+        通过绘制后端把最近一次渲染的结果画到面板上
+        :param msg: (panel_info, window)
         :return:
         """
-        # info, dc = msg
-        info, handle = msg
+        info, window = msg
         if self.info.name == info.name:  # 不处理没有挂钩的消息
-            # if self.zoomed_img:
-            #     # dc.SetBackgroundMode(wx.BRUSHSTYLE_TRANSPARENT)
-            #     dc.DrawBitmap(self.zoomed_img, self._left + self.img_offset.x, self._top + self.img_offset.y)
-            #     if self.info.select_box is not None:
-            #         dc.SetPen(wx.Pen('green', 1))
-            #         dc.SetBrush(wx.Brush(wx.Colour(0, 0, 0), wx.TRANSPARENT))
-            #         dc.DrawRectangle(self.info.select_box)
-            #     # print('self._left, self._top', self._left, self._top)
-            # else:
-            #     dc.SetBackground(wx.Brush('Gray'))
-            if self.zoomed_img:
-                # import time
-                # start_t = time.time()
-                # 该段直接在copy位图前才生成dc，避免窗口闪动
-                # todo:实际测试发现压缩文件压缩率高或存在特大尺寸图像时也会闪，
-                #  可能是因为读取和操作图像的某些耗费资源的部分仍然还留着主线程的缘故？
-                dc, ps = win32gui.BeginPaint(handle)
-                win32gui.SetStretchBltMode(dc, win32con.COLORONCOLOR)
-                ctypes.windll.gdi32.StretchDIBits(dc,
-                                                  int(self._left + self.img_offset.x),
-                                                  int(self._top + self.img_offset.y),
-                                                  self.zoomed_img.width, self.zoomed_img.height,
-                                                  0, 0,
-                                                  self.zoomed_img.width, self.zoomed_img.height,
-                                                  self.bmp_bits,
-                                                  byref(self.bmi),
-                                                  win32con.DIB_RGB_COLORS,
-                                                  win32con.SRCCOPY)
-                if self.info.select_box is not None:
-                    left, top, width, height = self.info.select_box
-                    if width > 1 and height > 1:
-                        # 右下角减1的原因：传过来的更新区域是以select_box为基础的rect，不画在更新区域内的话无法抹掉
-                        right, bottom = left + width - 1, top + height - 1
-                        pen = win32gui.CreatePen(win32con.PS_DOT, 1, win32api.RGB(0, 255, 0))
-                        win32gui.SelectObject(dc, pen)
-                        win32gui.MoveToEx(dc, left, top)
-                        win32gui.BeginPath(dc)
-                        win32gui.LineTo(dc, right, top)
-                        win32gui.LineTo(dc, right, bottom)
-                        win32gui.LineTo(dc, left, bottom)
-                        win32gui.LineTo(dc, left, top)
-                        win32gui.EndPath(dc)
-                        win32gui.StrokePath(dc)
-                win32gui.EndPaint(handle, ps)
-                # end_t = time.time()
-                # print('elapsed:', end_t - start_t)
+            frame = self.frame
+            if frame:
+                # 裁剪缩放都在渲染线程中完成，这里只绘制已经准备好的结果，
+                # 新的结果完成之前，继续按它自己的位置绘制上一次的结果
+                x, y = self._position(frame)
+                with trace.span('canvas.paint', panel=self.info.name):
+                    self.presenter.paint(window, frame.surface, x, y, self.info.select_box)
+                self._shown = (frame, x, y)
 
     @property
     def left(self):
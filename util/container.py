@@ -1,13 +1,29 @@
 from pathlib import Path
 from pubsub import pub
-from zipfile import ZipFile
+from zipfile import ZipFile, ZIP_STORED
 from rarfile import RarFile
-import io
+from functools import partial
+from util import archiveindex
+from util.archiveindex import ArchiveIndex, Member
+from util.rarstream import RarStream
+from util import watcher
+from threading import Thread, Lock, local
+from bisect import bisect_left, insort
+import heapq
 import logging
+import mmap
+import os
+import struct
+import time
+import wx
 
 log = logging.getLogger('container')
 log.setLevel(logging.ERROR)
 
+# zip本地文件头：签名，版本，标志，压缩方式，时间，日期，CRC，压缩后大小，大小，文件名长度，扩展字段长度
+ZIP_LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+LIST_INTERVAL = 0.2  # 后台读取目录时，每隔多少秒把已经找到的图像合并进img_list
+
 
 class CompressedFiLe(object):
     """
@@ -16,13 +32,90 @@ class CompressedFiLe(object):
 
     def __init__(self, file_name: Path):
         self.file_name = file_name
-        self.file = None
-        if file_name.suffix.lower() in ['.rar', '.cbr']:
-            self.file = RarFile(file_name)
-            self.mapping = None
-        elif file_name.suffix.lower() in ['.zip', 'cbz']:
-            self.file = ZipFile(file_name)
-            self.mapping = {}
+        self._file = None
+        self._stream = None
+        self._local = local()  # 每个解码线程各自的ZipFile，互不影响读取位置，可以并行读取
+        self._mmap = None  # 整个zip文件的只读映射，不压缩的文件直接切片
+        self._lock = Lock()  # 多个解码线程可能同时第一次读取
+        self._images = ()
+        self.index = None
+        self.is_rar = file_name.suffix.lower() in ['.rar', '.cbr']
+        if self.is_rar or file_name.suffix.lower() in ['.zip', '.cbz']:
+            # 打开过的压缩文件直接使用保存的索引，真正读取图像时才打开压缩文件
+            self.index = archiveindex.load(file_name)
+            self._dirty = self.index is None  # 新建或更新的索引要保存
+            if self.index is None:
+                self.index = self._build_index()
+
+    @property
+    def file(self):
+        with self._lock:
+            if self._file is None:
+                self._file = RarFile(self.file_name) if self.is_rar else ZipFile(self.file_name)
+            return self._file
+
+    @property
+    def stream(self):
+        """
+        固实压缩的rar顺序解压所有图像，见util.rarstream
+        :return: RarStream
+        """
+        with self._lock:
+            if self._stream is None:
+                order = [(name, self.index.get(name).size) for name in self.index.order]
+                self._stream = RarStream(self.file_name, order, self._images)
+            return self._stream
+
+    @property
+    def zip_file(self):
+        """
+        :return: 当前线程的ZipFile
+        """
+        zip_file = getattr(self._local, 'zip_file', None)
+        if zip_file is None:
+            zip_file = self._local.zip_file = ZipFile(self.file_name)
+        return zip_file
+
+    def _stored(self, member: Member):
+        """
+        不压缩的文件按本地文件头找到数据的位置，返回映射的切片，不复制数据
+        :param member:
+        :return: memoryview，无法直接读取时返回None
+        """
+        with self._lock:
+            if self._mmap is None:
+                with open(self.file_name, 'rb') as f:
+                    self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        header = ZIP_LOCAL_HEADER.unpack_from(self._mmap, member.offset)
+        signature, flags, name_length, extra_length = header[0], header[2], header[9], header[10]
+        if signature != b'PK\x03\x04' or flags & 0x1:  # 加密的文件交给zipfile
+            return None
+        start = member.offset + ZIP_LOCAL_HEADER.size + name_length + extra_length
+        if start + member.size > len(self._mmap):
+            return None
+        return memoryview(self._mmap)[start:start + member.size]
+
+    def _build_index(self):
+        """
+        解析整个压缩文件，记录所有文件的名称、大小、CRC和偏移
+        :return: ArchiveIndex
+        """
+        key = archiveindex.archive_key(self.file_name)
+        members = []
+        order = []
+        for info in self.file.infolist():
+            if info.is_dir():
+                continue
+            if self.is_rar:
+                members.append(Member(info.filename, info.filename, info.file_size, info.compress_size,
+                                      info.CRC, None, info.compress_type))
+                order.append(info.filename)
+            else:
+                members.append(Member(self._convert_filename(info.filename), info.filename, info.file_size,
+                                      info.compress_size, info.CRC, info.header_offset, info.compress_type))
+        members.sort()
+        solid = self.file.is_solid() if self.is_rar else False
+        return ArchiveIndex(key, members, solid, order)
 
     def list_files(self, file_format: list):
         """
@@ -30,46 +123,86 @@ class CompressedFiLe(object):
         :param file_format: 需要读取的后缀名类别
         :return:
         """
-        if self.file is None:
+        if self.index is None:
             log.info('Container: invalid compressed file.')
             return False
-        img_list = []
-        for p in self.file.namelist():
-            if Path(p).suffix.lower() in file_format:
-                if self.mapping is None:  # RarFile
-                    img_list.append(p)
-                else:  # ZipFile
-                    img_list.append(self._convert_filename(p))
-        img_list.sort()
-        return img_list
+        # 筛选结果也存在索引里，再次打开时直接使用
+        file_format = frozenset(file_format)
+        img_list = self.index.lists.get(file_format)
+        if img_list is None:
+            # 索引已经按文件名排好序
+            img_list = [name for name in self.index.names if name[name.rfind('.'):].lower() in file_format]
+            self.index.lists[file_format] = img_list
+            self._dirty = True
+        if self._dirty:
+            archiveindex.save(self.index)
+            self._dirty = False
+        self._images = img_list
+        return list(img_list)
         # todo:可能以后会加入文件格式和修改日期的信息
         #         return [(Path(self._convert_filename(f.filename)),
         #                  datetime(*f.date_time))
         #                 for f in self.file.infolist()
         #                 if f.filename[-1] not in '\\/']
 
-    def open_file(self, path):
-        if self.mapping is None:  # RarFile
-            return self.file.open(path)
-        else:  # ZipFile, need name mapping
+    def read(self, path, cancelled=None):
+        """
+        在解码线程中调用，返回文件的内容
+        :param path: 解码后的文件名
+        :param cancelled: 返回True时放弃等待的函数，只有顺序解压时需要等待
+        :return: bytes-like
+        """
+        if self.index.solid:
             try:
-                encode_path = self.mapping[path]
-            except KeyError:
-                encode_path = path
-            return self.file.open(encode_path)
+                return self.stream.read(path, cancelled)
+            except (OSError, KeyError) as e:
+                # 没有unrar或解压出错时，退回到逐个文件读取
+                log.info('Container: streaming failed, {}'.format(e))
+        member = self.index.get(path)
+        if not self.is_rar and member is not None:
+            if member.compress_type == ZIP_STORED:
+                try:
+                    data = self._stored(member)
+                except (OSError, ValueError, struct.error) as e:
+                    log.info('Container: mmap failed, {}'.format(e))
+                    data = None
+                if data is not None:
+                    return data
+            return self.zip_file.read(member.raw_name)
+        with self.open_file(path) as fp:
+            return fp.read()
 
-    def _convert_filename(self, path):
+    def open_file(self, path):
+        member = self.index.get(path)
+        # zip需要用原始的文件名打开
+        return self.file.open(member.raw_name if member is not None else path)
+
+    def get_crc(self, path):
+        """
+        返回压缩文件内图像的CRC，和压缩文件本身一起标识图像内容
+        :param path:
+        :return: int，没有这个文件时返回None
+        """
+        member = self.index.get(path)
+        return member.crc if member is not None else None
+
+    @staticmethod
+    def _convert_filename(path):
         # zipfile decodes utf - 8, but not cp437
         # todo:测试对shift-jis的支持
         try:
-            decoded_path = path.encode('cp437').decode('gbk')
-            self.mapping[decoded_path] = path
-            return decoded_path
-        except UnicodeDecodeError:
+            return path.encode('cp437').decode('gbk')
+        except (UnicodeEncodeError, UnicodeDecodeError):
             # decoded_path = path.decode('ascii', 'ignore')
-            decoded_path = path
-            self.mapping[decoded_path] = path
-            return decoded_path
+            return path
+
+    def close(self):
+        """
+        不再使用时结束顺序解压，压缩文件本身可能还在被解码线程读取，交给垃圾回收关闭
+        :return:
+        """
+        if self._stream is not None:
+            self._stream.close()
 
 
 class Container(object):
@@ -84,6 +217,7 @@ class Container(object):
                               '.jpx', '.mpeg', '.mpg', '.msp', '.pcd', '.pcx', '.pxr', '.apng', '.png', '.pbm', '.pgm',
                               '.pnm', '.ppm', '.psd', '.bw', '.rgb', '.rgba', '.sgi', '.ras', '.icb', '.tga', '.vda',
                               '.vst', '.tif', '.tiff', '.webp', '.emf', '.wmf', '.xbm', '.xpm','.avif']
+        self.img_suffixes = frozenset(self.img_supported)
         self.compressed_file_supported = ['.rar', '.zip', '.cbz', '.cbr']
         self.img_path = Path.cwd()
         self.img_idx = 0
@@ -92,6 +226,13 @@ class Container(object):
         self.compressed_file = None
         self.zip_file_name_mapping = {}
         self.file_name = None
+        self._listing = None  # 当前后台读取目录的标识，打开其它文件时作废
+        self._announce = False  # 后台读取到第一批图像后是否要发送load_image消息
+        self._status = None  # 最近一次的状态栏信息，img_list改变时重新发送
+        self._shown = None  # 状态栏上显示的(img_idx, len(img_list))
+        self.watcher = None  # 监视当前目录的变化
+        self._listed = False  # 后台读取目录是否已经完成
+        self._changes = []  # 完成之前收到的目录变化，完成后再应用
         pub.subscribe(self.on_open_file, 'open.file')
         pub.subscribe(self.on_update_status, 'main_control.update_status')
 
@@ -106,34 +247,203 @@ class Container(object):
                 self.img_path = file_path if file_path.is_dir() else file_path.parent
                 pub.sendMessage('container.load_image', msg=(self.img_idx, 0))
 
+    def is_image(self, name):
+        """
+        :param name: 文件名
+        :return: 后缀名是否支持的图像格式
+        """
+        return name[name.rfind('.'):].lower() in self.img_suffixes
+
     def load_dir(self, dir_name: Path):
         """
         哪怕只打开一张图片、即使选择的不是图像和压缩文件，也读取整个目录
+        选择的是图像时先只显示它，目录在后台读取，分批合并进img_list
         :param dir_name:
-        :return:
+        :return: 选择的是图像时返回True；否则返回False，后台找到图像后再发送load_image消息
         """
         if dir_name.is_dir():
             img_path = dir_name
         else:
             img_path = dir_name.parent
-        img_list = []
-        for p in img_path.iterdir():
-            if p.suffix.lower() in self.img_supported:
-                img_list.append(p)
-        if len(img_list) > 0:
-            img_list.sort()
-            if dir_name in img_list:
-                img_idx = img_list.index(dir_name)
-            else:
-                img_idx = 0
-            self.img_path = img_path
+        picked = not dir_name.is_dir() and self.is_image(dir_name.name)
+        if picked:
+            self._set_dir(img_path, [dir_name], 0)
+        self._listing = token = object()
+        self._announce = not picked
+        self._listed = False
+        self._changes = []
+        # 先开始监视再读取目录，期间的变化在读取完成后应用
+        self._stop_watching()
+        try:
+            self.watcher = watcher.watch(img_path, partial(self._on_changed, img_path, token))
+        except OSError as e:
+            log.error('Container: watching {} failed, {}'.format(img_path, e))
+        thread = Thread(target=self._list_dir, args=(img_path, token), name='list-dir')
+        thread.daemon = True
+        thread.start()
+        return picked
+
+    def _set_dir(self, img_path, img_list, img_idx):
+        self.img_path = img_path
+        self.img_list = img_list
+        self.img_idx = img_idx
+        self.is_compressed_file = False
+        if self.compressed_file is not None:
+            self.compressed_file.close()
+        self.compressed_file = None
+        self._status = None
+
+    def _list_dir(self, img_path: Path, token):
+        """
+        在后台线程中用os.scandir读取目录，每隔LIST_INTERVAL把排好序的结果交给主线程
+        :param img_path:
+        :param token: 打开其它文件后self._listing改变，不再继续
+        :return:
+        """
+        found = []
+        batch = []
+        last = time.time()
+        try:
+            with os.scandir(img_path) as it:
+                for entry in it:
+                    if self._listing is not token:
+                        return
+                    if self.is_image(entry.name) and entry.is_file():
+                        batch.append(img_path / entry.name)
+                    if batch and time.time() - last > LIST_INTERVAL:
+                        # 每次交出的都是新的列表，主线程可以直接使用
+                        found = list(heapq.merge(found, sorted(batch)))
+                        batch = []
+                        wx.CallAfter(self._on_listed, img_path, token, found)
+                        last = time.time()
+        except OSError as e:
+            log.error('Container: listing {} failed, {}'.format(img_path, e))
+        found = list(heapq.merge(found, sorted(batch)))
+        wx.CallAfter(self._on_listed, img_path, token, found, True)
+
+    def _on_listed(self, img_path, token, found, finished=False):
+        """
+        在主线程中换成新读取到的列表，img_idx仍然指向当前的图像
+        :param img_path:
+        :param token:
+        :param found: 排好序的图像路径
+        :param finished: 是否已经读取完整个目录
+        :return:
+        """
+        if token is not self._listing:
+            return
+        if finished:
+            self._listed = True
+            changes, self._changes = self._changes, []
+            if found:
+                self._on_listed(img_path, token, found)
+            elif self._announce:
+                # 目录中没有图像，监视已经换到了这个目录，不能留着之前的列表
+                self._set_dir(img_path, [], 0)
+                pub.sendMessage('container.list_changed', msg=(0,))
+            for change in changes:
+                self._on_changed(img_path, token, *change)
+            return
+        if not found:
+            return
+        if self._announce:
+            self._announce = False
+            self._set_dir(img_path, found, 0)
+            pub.sendMessage('container.list_changed', msg=(len(self.img_list),))
+            pub.sendMessage('container.load_image', msg=(self.img_idx, 0))
+            return
+        current = self.img_list[self.img_idx]
+        idx = bisect_left(found, current)
+        if idx == len(found) or found[idx] != current:
+            # 当前的图像还没有读取到，先插入到列表中
+            found = list(found)
+            insort(found, current)
+        self.img_list = found
+        self.img_idx = idx
+        pub.sendMessage('container.list_changed', msg=(len(self.img_list),))
+        self._resend_status()
+
+    def _on_changed(self, img_path, token, added, removed, modified):
+        """
+        目录中的文件发生变化，在主线程中增量更新img_list，img_idx仍然指向当前的图像
+        修改或删除的图像从缓存中去掉，当前的图像被修改时重新读取
+        :param img_path:
+        :param token:
+        :param added: 增加的文件名
+        :param removed: 删除的文件名，改名是删除旧的再增加新的
+        :param modified: 内容改变的文件名
+        :return:
+        """
+        if token is not self._listing:
+            return
+        if not self._listed:
+            self._changes.append((added, removed, modified))
+            return
+        added = sorted(img_path / name for name in added if self.is_image(name))
+        removed = {img_path / name for name in removed if self.is_image(name)}
+        modified = [img_path / name for name in modified if self.is_image(name)]
+        if added and not self._announce:
+            # 改名覆盖已有的文件时只有增加的事件，看作修改
+            replaced = [p for p in added if p not in removed and self._listed_at(p) is not None]
+            if replaced:
+                modified.extend(replaced)
+                added = [p for p in added if p not in replaced]
+        if added or removed:
+            self._update_list(img_path, added, removed)
+        # 列表更新后再通知缓存，当前图像被修改时按新的img_idx重新读取
+        if removed or modified:
+            pub.sendMessage('cache.invalidate', msg=([(str(p),) for p in list(removed) + modified],))
+
+    def _update_list(self, img_path, added, removed):
+        """
+        把增加和删除的图像合并到img_list
+        :param img_path:
+        :param added: 排好序的图像路径
+        :param removed: 图像路径的集合
+        :return:
+        """
+        if self._announce:
+            # 打开的目录原来没有图像
+            if added:
+                self._announce = False
+                self._set_dir(img_path, added, 0)
+                pub.sendMessage('container.list_changed', msg=(len(self.img_list),))
+                pub.sendMessage('container.load_image', msg=(self.img_idx, 0))
+            return
+        current = self.img_list[self.img_idx] if self.img_list else None
+        kept = [p for p in self.img_list if p not in removed] if removed else self.img_list
+        img_list = list(heapq.merge(kept, added))
+        if not img_list:
             self.img_list = img_list
-            self.img_idx = img_idx
-            self.is_compressed_file = False
-            self.compressed_file = None
-            return True
+            self.img_idx = 0
+            pub.sendMessage('container.list_changed', msg=(0,))
+            return
+        idx = min(bisect_left(img_list, current), len(img_list) - 1) if current is not None else 0
+        self.img_list = img_list
+        self.img_idx = idx
+        pub.sendMessage('container.list_changed', msg=(len(self.img_list),))
+        if current in removed:
+            # 当前的图像被删除，显示它后面的一张
+            pub.sendMessage('container.load_image', msg=(self.img_idx, 0))
         else:
-            return False
+            self._resend_status()
+
+    def _resend_status(self):
+        # 列表增减后，当前图像的序号或总数变了才更新状态栏
+        if self._status is not None and self._shown != (self.img_idx, len(self.img_list)):
+            self.on_update_status(self._status)
+
+    def _listed_at(self, path):
+        # img_list是排好序的，二分查找路径的位置，不在列表中时返回None
+        idx = bisect_left(self.img_list, path)
+        if idx < len(self.img_list) and self.img_list[idx] == path:
+            return idx
+        return None
+
+    def _stop_watching(self):
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
 
     def load_compressed_file(self, file_name: Path):
         try:
@@ -143,6 +453,10 @@ class Container(object):
             return False
         img_list = compressed_file.list_files(self.img_supported)
         if len(img_list) > 0:
+            self._listing = None
+            self._stop_watching()
+            if self.compressed_file is not None:
+                self.compressed_file.close()
             self.img_idx = 0
             self.is_compressed_file = True
             self.file_name = file_name
@@ -171,10 +485,96 @@ class Container(object):
             self.img_idx = img_idx
         if not self.compressed_file:
             return self.img_list[img_idx]
-        else:  # rar和zip的支持
-            pub.sendMessage('busy', msg=(True,))
-            fp = self.compressed_file.open_file(self.img_list[img_idx])
-            return io.BufferedReader(fp)
+        else:  # rar和zip的支持，交给解码线程读取
+            return self.get_source(img_idx)
+
+    def get_source(self, idx):
+        """
+        返回预读用的图像来源，不改变当前索引
+        普通文件直接返回路径，压缩文件返回一个读取文件内容的函数，在cache线程中调用时才真正读取
+        :param idx:
+        :return:
+        """
+        if len(self.img_list) < 1:
+            return None
+        if not self.compressed_file:
+            return self.img_list[idx]
+        else:
+            return partial(self._read_member, self.compressed_file, self.img_list[idx])
+
+    @staticmethod
+    def _read_member(compressed_file, name, cancelled=None):
+        return compressed_file.read(name, cancelled)
+
+    def get_key(self, idx):
+        """
+        返回图像的稳定标识，用作缓存的key，压缩文件内的图像用(压缩文件路径,文件名)标识
+        :param idx:
+        :return: tuple
+        """
+        if len(self.img_list) < 1:
+            return None
+        if not self.compressed_file:
+            return str(self.img_list[idx]),
+        else:
+            return str(self.file_name), self.img_list[idx]
+
+    def index_of(self, key):
+        """
+        get_key的反查，先查找当前图像附近
+        :param key:
+        :return: int，不在img_list中时返回None
+        """
+        for idx in (self.img_idx, self.img_idx - 1, self.img_idx + 1):
+            if 0 <= idx < len(self.img_list) and self.get_key(idx) == key:
+                return idx
+        if not self.compressed_file:
+            return self._listed_at(Path(key[0])) if len(key) == 1 else None
+        if len(key) != 2 or key[0] != str(self.file_name):
+            return None
+        try:
+            return self.img_list.index(key[1])
+        except ValueError:
+            return None
+
+    def get_disk_key(self, idx):
+        """
+        返回磁盘缓存用的标识，文件内容改变后标识也会改变
+        普通文件用(路径,大小,修改时间)，压缩文件内的图像用(压缩文件路径,大小,修改时间,文件名,CRC)
+        :param idx:
+        :return: tuple，文件无法访问时返回None
+        """
+        source = self.get_disk_key_source(idx)
+        return source() if source is not None else None
+
+    def get_disk_key_source(self, idx):
+        """
+        返回计算磁盘缓存标识的函数，和get_source一样不访问文件，在后台线程中调用时才stat
+        :param idx:
+        :return: 不带参数的函数，返回值同get_disk_key
+        """
+        if len(self.img_list) < 1:
+            return None
+        if not self.compressed_file:
+            return partial(self._file_disk_key, self.img_list[idx])
+        else:
+            return partial(self._member_disk_key, self.file_name, self.compressed_file, self.img_list[idx])
+
+    @staticmethod
+    def _file_disk_key(path):
+        try:
+            st = Path(path).stat()
+        except OSError:
+            return None
+        return str(path), st.st_size, st.st_mtime_ns
+
+    @staticmethod
+    def _member_disk_key(file_name, compressed_file, name):
+        try:
+            st = file_name.stat()
+            return str(file_name), st.st_size, st.st_mtime_ns, name, compressed_file.get_crc(name)
+        except (OSError, KeyError):
+            return None
 
     def get_name(self, idx):
         """
@@ -192,9 +592,11 @@ class Container(object):
         :return:
         """
         if len(self.img_list) > 0:
-            w, h = msg
+            self._status = msg
+            self._shown = (self.img_idx, len(self.img_list))
+            w, h, decoder = msg
             name = Path(self.img_list[self.img_idx]).name
             if self.is_compressed_file:
                 name = self.file_name.name + ' : ' + name
             pub.sendMessage('container.update_status_bar',
-                            msg=(self.img_idx, len(self.img_list), name, self.img_path, w, h))
+                            msg=(self.img_idx, len(self.img_list), name, self.img_path, w, h, decoder))
@@ -1,6 +1,16 @@
+from collections import deque
 from pubsub import pub
-from util.cache import ImageCacheLoadRequest
+from util.cache import ImageCacheLoadRequest, DEFAULT_CACHE_BUDGET
+from util.canvas import source_box
 from util.container import Container
+from util.diff import rotate_crop
+from util import present, trace
+import time
+
+PREFETCH_AHEAD = 2  # 翻页方向上默认预读的张数
+PREFETCH_BEHIND = 1  # 反方向默认预读的张数
+PREFETCH_MAX = 16  # 预读窗口的最大张数
+PREFETCH_LOOKAHEAD = 1.  # 按翻页速度预读多少秒内会看到的图像
 
 
 class MainController(object):
@@ -11,14 +21,31 @@ class MainController(object):
     存储各画布面板对应的画布
     """
 
-    def __init__(self, container: Container, panel_info_list):
+    def __init__(self, container: Container, panel_info_list, settings=None):
         self.container = container
+        self.settings = settings if settings is not None else {}
+        self.prefetch_ahead = self.settings.get('prefetch_ahead', PREFETCH_AHEAD)
+        self.prefetch_behind = self.settings.get('prefetch_behind', PREFETCH_BEHIND)
+        self.prefetch_max = self.settings.get('prefetch_max', PREFETCH_MAX)
+        self.cache_budget = self.settings.get('cache_budget', DEFAULT_CACHE_BUDGET)
+        self.reduced_decode = self.settings.get('reduced_decode', True)
+        # 绘制后端，见util.present.configure
+        present.configure(self.settings.get('presenter'))
+        # 追踪各阶段的耗时，给出文件名时开启，见util.trace
+        trace.configure(self.settings.get('trace'))
+        self._nav_times = deque(maxlen=16)  # 最近几次翻页的时间，用来估计翻页速度
+        self._nav_direction = 1
+        self.generation = 0  # 浏览代数，每次翻页加一，用来取消过时的读取请求
         self.file_name = None
+        self.file_key = None
         self.panels = {}  # PanelInfo dict
         for item in panel_info_list:
             self.panels[item.name] = item
         self.canvases = None
         self.img = None
+        self.original_img = None  # 旋转前的图像，和相邻图像的比较结果保存在它上面
+        self._change_region = 0  # 下次跳转时从第几个变化区域开始
+        self.rotation = 0  # 当前图像顺时针旋转了几个90°，替换为高分辨率图像时需要同样旋转
         self._pending_request = None
         # 面板消息
         pub.subscribe(self.on_zoom_change, 'zoom_change')
@@ -26,21 +53,34 @@ class MainController(object):
         pub.subscribe(self.on_load_image, 'container.load_image')
         pub.subscribe(self.on_paint_canvas, 'panel.paint_canvas')
         pub.subscribe(self.on_image_move, 'panel.move_image')
+        pub.subscribe(self.on_gesture_end, 'panel.gesture_end')
         pub.subscribe(self.on_rotate, 'frame.rotate_image')
+        pub.subscribe(self.on_jump_to_changes, 'frame.jump_to_changes')
         pub.subscribe(self.on_show_panels, 'auiMgr.show_pane')
         # cache消息
         pub.subscribe(self.on_image_loaded, 'cache.image_loaded')
+        pub.subscribe(self.on_invalidated, 'cache.invalidated')
 
     def on_paint_canvas(self, msg):
-        info, dc = msg
+        info, window = msg
         if self.canvases is not None:
             self.canvases[info.name].paint_canvas(msg)
 
     def on_image_move(self, msg):
         if self.canvases is not None:
             info = msg[0]
-            self.canvases[info.name].move_image(msg)
-            pub.sendMessage('main_control.refresh_panel', msg=(info,))
+            delta = self.canvases[info.name].move_image(msg)
+            if delta is None:
+                pub.sendMessage('main_control.refresh_panel', msg=(info,))
+            elif delta != (0, 0):
+                # 滚动屏幕上已有的像素，只重绘新露出来的部分
+                pub.sendMessage('main_control.scroll_panel', msg=(info,) + delta)
+
+    def on_gesture_end(self, msg):
+        # 拖动、缩放或改变尺寸停下来以后，用高质量重新渲染
+        if self.canvases is not None:
+            info = msg[0]
+            self.canvases[info.name].refine()
 
     def on_zoom_change(self, msg):
         """
@@ -64,14 +104,44 @@ class MainController(object):
         elif crop:
             for key in self.canvases.keys():
                 if key != 'main_canvas':
-                    self.canvases[key].calculate_zoom(self.img, self.panels[key], crop=crop)
-                    refreshed = self.canvases[key].zoom()
-                    if refreshed:
-                        pub.sendMessage('main_control.refresh_panel', msg=(self.panels[key],))  # 发消息给panel更新
-                else:  # 要将主画布的选框也消除
-                    pub.sendMessage('main_control.refresh_panel', msg=(info,))
+                    self._crop_panel(key, crop)
+            # 要将主画布的选框也消除
+            pub.sendMessage('main_control.refresh_panel', msg=(info,))
         elif info.crop_rect is not None:  # 要将其它画布的选框消除
             pub.sendMessage('main_control.refresh_panel', msg=(info,))
+        self._refine()
+
+    def _crop_panel(self, key, crop):
+        self.canvases[key].calculate_zoom(self.img, self.panels[key], crop=crop)
+        refreshed = self.canvases[key].zoom()
+        if refreshed:
+            pub.sendMessage('main_control.refresh_panel', msg=(self.panels[key],))  # 发消息给panel更新
+
+    def on_jump_to_changes(self, msg):
+        """
+        把其它画布依次裁剪到当前图像和相邻差分不同的区域，变化多的区域在前，再按一次显示后面的区域
+        先和翻页过来的那一张比较，比较结果由util.diff在后台准备，还没有结果时不做任何事
+        :param msg:
+        :return:
+        """
+        if self.canvases is None or self.original_img is None:
+            return
+        idx = self.container.img_idx
+        if self.container.get_key(idx) != self.file_key:
+            return
+        for i in (idx - self._nav_direction, idx + self._nav_direction):
+            if 0 <= i < len(self.container.img_list):
+                changes = self.original_img.diffs.get(self.container.get_key(i))
+                if changes is not None and changes.boxes:
+                    break
+        else:
+            return
+        keys = [key for key in self.canvases.keys() if key != 'main_canvas']
+        for n, key in enumerate(keys):
+            box = changes.boxes[(self._change_region + n) % len(changes.boxes)]
+            self._crop_panel(key, rotate_crop(changes.crop(box), self.rotation))
+        self._change_region = (self._change_region + len(keys)) % len(changes.boxes)
+        self._refine()
 
     def on_rotate(self, msg):
         if self.canvases is None:
@@ -79,6 +149,7 @@ class MainController(object):
         direction = msg[0]
         # 旋转源图像
         self.img = self.img.rotate(direction)
+        self.rotation = (self.rotation + direction) % 4
         for key in self.canvases.keys():
             self.canvases[key].reset(self.img)
             pub.sendMessage('main_control.refresh_panel', msg=(self.panels[key],))
@@ -107,6 +178,7 @@ class MainController(object):
             self.panels[name].is_shown = show
             if show and self.canvases is not None:
                 self.canvases[name].zoom(True)
+                self._refine()
 
     def on_load_image(self, msg):
         """
@@ -120,17 +192,155 @@ class MainController(object):
             file_name = self.container.get_item(direction=direction)
         else:
             file_name = self.container.get_item(idx=idx)
-        if file_name and file_name != self.file_name:
-            req = ImageCacheLoadRequest(file_name, self.panels, self.canvases)
-            self._pending_request = req
+        key = self.container.get_key(self.container.img_idx)
+        if not file_name:
+            return
+        if key == self.file_key:
+            if self._pending_request is not None:
+                # 在新的图像显示之前又回到了当前的图像，等待中的请求和预读都已经过时
+                self.generation += 1
+                pub.sendMessage('cache.clear_pending', msg=(self.generation, {key}))
+                self._pending_request = None
+                pub.sendMessage('busy', msg=(False,))
+                self._send_status()
+        else:
+            self.generation += 1
+            # 之后主线程上的span都属于这次翻页，直到图像显示出来
+            trace.set_context(self.generation)
+            with trace.span('controller.load_image', idx=self.container.img_idx):
+                self._request_image(file_name, key, direction)
+
+    def _send_status(self):
+        # 状态栏和文件列表显示当前的图像
+        pub.sendMessage('main_control.update_status',
+                        msg=(self.img.full_width, self.img.full_height,
+                             '{}/{}'.format(self.img.format, self.img.backend)))
+
+    def _request_image(self, file_name, key, direction):
+        """
+        发出当前图像和预读窗口内图像的读取请求
+        :param file_name: 当前图像的来源
+        :param key:
+        :param direction: 翻页方向
+        :return:
+        """
+        window = self._prefetch_window(direction)
+        # 不在新窗口内的请求都已经不可能显示了，先从cache的队列中取消
+        keep = {key}
+        keep.update(self.container.get_key(i) for i, _ in window)
+        pub.sendMessage('cache.clear_pending', msg=(self.generation, keep))
+        target = self._target_size()
+        req = ImageCacheLoadRequest(file_name, self.panels, self.canvases, key=key, generation=self.generation,
+                                    target_size=target,
+                                    disk_key=self.container.get_disk_key_source(self.container.img_idx))
+        self._pending_request = req
+        pub.sendMessage('cache.load_image', msg=(req,))
+        # 预读其它图像
+        for i, priority in window:
+            req = ImageCacheLoadRequest(self.container.get_source(i),
+                                        self.panels,
+                                        self.canvases,
+                                        key=self.container.get_key(i),
+                                        priority=priority,
+                                        generation=self.generation,
+                                        target_size=target,
+                                        disk_key=self.container.get_disk_key_source(i))
             pub.sendMessage('cache.load_image', msg=(req,))
-            # 预读其它图像
-            if direction:
-                for i in range(1):
-                    req = ImageCacheLoadRequest(self.container.get_item(direction * i + 1, delay=True),
-                                                self.panels,
-                                                self.canvases)
-                    pub.sendMessage('cache.load_image', msg=(req,))
+
+    def _target_size(self):
+        """
+        根据各面板的尺寸、裁剪和缩放，给出降低分辨率解码时需要的尺寸范围
+        :return: [(w, h)]，不降低分辨率解码时返回None
+        """
+        if not self.reduced_decode:
+            return None
+        boxes = []
+        for key, info in self.panels.items():
+            if info.is_shown:
+                crop = self.canvases[key].crop if self.canvases is not None else (0., 0., 1., 1.)
+                boxes.append(source_box(info, crop))
+        return boxes
+
+    def _refine(self):
+        """
+        当前图像是预览图，而裁剪或放大后需要更高的分辨率时，在后台解码原图
+        :return:
+        """
+        if self.img is None or self.img.scale >= 1:
+            return
+        # 正在等待新的图像时不处理
+        if self.container.get_key(self.container.img_idx) != self.file_key:
+            return
+        if self.img.satisfies(self._target_size()):
+            return
+        req = ImageCacheLoadRequest(self.container.get_source(self.container.img_idx),
+                                    self.panels,
+                                    self.canvases,
+                                    key=self.file_key,
+                                    generation=self.generation,
+                                    disk_key=self.container.get_disk_key_source(self.container.img_idx))
+        pub.sendMessage('cache.load_image', msg=(req,))
+
+    def _swap_image(self, img):
+        """
+        替换为更高分辨率的同一图像，各画布保持裁剪和显示位置
+        :param img:
+        :return:
+        """
+        self.original_img = img
+        for _ in range(self.rotation):
+            img = img.rotate(1)
+        self.img = img
+        for key in self.canvases.keys():
+            self.canvases[key].set_image(img)
+            if self.panels[key].is_shown:
+                pub.sendMessage('main_control.refresh_panel', msg=(self.panels[key],))
+
+    def _prefetch_window(self, direction):
+        """
+        计算预读窗口，翻页越快窗口越宽，并偏向翻页的方向，总张数受缓存预算限制
+        :param direction: 翻页方向，0表示直接跳转，沿用上次的方向
+        :return: [(idx, priority)]，priority为与当前图像的距离，反方向的稍微靠后
+        """
+        length = len(self.container.img_list)
+        if length < 2:
+            return []
+        now = time.monotonic()
+        self._nav_times.append(now)
+        if direction:
+            self._nav_direction = direction
+        # 最近两秒内的翻页速度，单位张/秒
+        recent = [t for t in self._nav_times if now - t < 2.]
+        speed = (len(recent) - 1) / (now - recent[0]) if now > recent[0] else 0.
+        ahead = self.prefetch_ahead + int(speed * PREFETCH_LOOKAHEAD)
+        behind = self.prefetch_behind
+        # 用当前图像的大小估计每张图占用的缓存，给当前图像留一个位置
+        limit = min(self.prefetch_max, length - 1)
+        if self.img is not None and self.img.content is not None and self.img.content.nbytes > 0:
+            limit = min(limit, max(0, self.cache_budget // self.img.content.nbytes - 1))
+        ahead = min(ahead, limit)
+        behind = min(behind, limit - ahead)
+        window = []
+        idx = self.container.img_idx
+        for i in range(1, ahead + 1):
+            window.append(((idx + self._nav_direction * i) % length, i))
+        for i in range(1, behind + 1):
+            window.append(((idx - self._nav_direction * i) % length, i + 0.5))
+        return window
+
+    def on_invalidated(self, msg):
+        """
+        当前显示或正在等待的图像文件被修改时重新读取
+        在cache去掉旧的结果之后才收到，不依赖pubsub调用各订阅者的顺序
+        :param msg: (keys,)
+        :return:
+        """
+        keys = msg[0]
+        key = self.container.get_key(self.container.img_idx)
+        pending = self._pending_request is not None and self._pending_request.key in keys
+        if pending or (self.file_key in keys and self.file_key == key):
+            self.file_key = None
+            pub.sendMessage('container.load_image', msg=(self.container.img_idx, 0))
 
     def on_image_loaded(self, msg):
         """
@@ -146,14 +356,25 @@ class MainController(object):
             # 从req里拿到file_name,panels,canvases,img等信息
             # print('in:', req.file_name, 'returned')
             # print('-' * 50)
-            req.update_canvases(True)  # 目前看来，因为cv2的效率，放在主线程应该不会造成多大延迟
+            # 命中缓存时req是预读时的请求，关联id以等待中的请求为准
+            trace.set_context(self._pending_request.generation)
+            with trace.span('controller.update_canvases', key=str(req.key)):
+                req.update_canvases(True)  # 只计算显示位置，裁剪缩放交给渲染线程
             pub.sendMessage('busy', msg=(False,))
             self.file_name = req.file_name
+            self.file_key = req.key
             self.panels = req.panels
             self.canvases = req.canvases
             self.img = req.img
+            self.original_img = req.img
+            self._change_region = 0
+            self.rotation = 0
             self._pending_request = None
             # 发送消息，所有面板都需要响应
             # for info in self.panels.values():
             #     pub.sendMessage('main_control.refresh_panel', msg=(info,))
-            pub.sendMessage('main_control.update_status', msg=(self.img.width, self.img.height))
+            self._send_status()
+            self._refine()
+        elif req.key == self.file_key and self.img is not None and req.img.scale > self.img.scale:
+            # 后台解码出了更高的分辨率
+            self._swap_image(req.img)
@@ -0,0 +1,176 @@
+from PIL import Image
+import pillow_avif
+import cv2
+import numpy as np
+from collections import Counter
+from threading import Lock
+import io
+import math
+import logging
+
+log = logging.getLogger('decoders')
+log.setLevel(logging.ERROR)
+
+
+class LoadCancelled(Exception):
+    """
+    读取请求已被新的浏览操作取代，在读取的阶段之间抛出，放弃剩余的解码
+    """
+    pass
+
+
+def required_scale(target_size, width, height):
+    """
+    计算满足所有面板显示需要的最小比例
+    :param target_size: [(w, h)]，不受限的一边为inf
+    :param width: 原图宽
+    :param height: 原图高
+    :return: 不超过1的比例
+    """
+    scale = 0.
+    for w, h in target_size:
+        scale = max(scale, min(w / width, h / height))
+    return min(scale, 1.)
+
+
+def check(cancelled):
+    if cancelled is not None and cancelled():
+        raise LoadCancelled()
+
+
+def sniff(data):
+    """
+    根据文件头判断格式，不依赖文件名，压缩文件内的fp也能用
+    :param data: bytes-like
+    :return: 'JPEG','PNG','WEBP'，其它返回None
+    """
+    head = bytes(data[:12])
+    if head[:3] == b'\xff\xd8\xff':
+        return 'JPEG'
+    if head[:8] == b'\x89PNG\r\n\x1a\n':
+        return 'PNG'
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'WEBP'
+    return None
+
+
+def read_bytes(fp):
+    """
+    :param fp: 文件名、fp或者bytes-like
+    :return: bytes-like
+    """
+    if isinstance(fp, (bytes, bytearray, memoryview)):
+        return fp
+    if hasattr(fp, 'read'):
+        return fp.read()
+    with open(fp, 'rb') as f:
+        return f.read()
+
+
+class PilDecoder(object):
+    """
+    PIL解码，支持Container.img_supported中的所有格式，JPEG可以用draft降低分辨率解码
+    """
+    name = 'pil'
+
+    def decode(self, data, target_size=None, cancelled=None):
+        """
+        :param data: bytes-like
+        :param target_size: [(w, h)]，给出时只解码够用的分辨率
+        :param cancelled: 返回True时放弃解码的函数
+        :return: (BGR的numpy数组, 相对原图的比例)，无法解码时抛出异常
+        """
+        img = Image.open(io.BytesIO(data))
+        check(cancelled)
+        full_width = img.size[0]
+        if target_size:
+            scale = required_scale(target_size, *img.size)
+            # 只有JPEG支持draft，其它格式返回None，照常完整解码
+            if scale < 1:
+                img.draft(img.mode, (math.ceil(img.size[0] * scale), math.ceil(img.size[1] * scale)))
+        if not img.mode == 'RGB':
+            img = img.convert('RGB')
+        else:
+            img.load()
+        check(cancelled)
+        # 奇怪的是，windows设备的Bitmap居然也用的BGR格式？
+        return cv2.cvtColor(np.asarray(img), cv2.COLOR_RGB2BGR), img.size[0] / full_width
+
+
+class Cv2Decoder(object):
+    """
+    cv2.imdecode直接解码成BGR的uint8数组，没有PIL那样的RGB中间结果和两次转换
+    JPEG可以按1/2,1/4,1/8降低分辨率解码
+    """
+    name = 'cv2'
+    reduced_flags = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4), (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+    def decode(self, data, target_size=None, cancelled=None):
+        # 和PIL一样不按EXIF旋转，统一由用户旋转
+        flags = cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION
+        full_width = None
+        if target_size and sniff(data) == 'JPEG':
+            # PIL.Image.open只解析文件头，用来取得原图尺寸
+            full_width, full_height = Image.open(io.BytesIO(data)).size
+            scale = required_scale(target_size, full_width, full_height)
+            for factor, flag in self.reduced_flags:
+                if 1 / factor >= scale:
+                    flags = flag | cv2.IMREAD_IGNORE_ORIENTATION
+                    break
+        content = cv2.imdecode(np.frombuffer(data, np.uint8), flags)
+        if content is None:
+            raise ValueError('cv2 cannot decode this image')
+        check(cancelled)
+        return content, (content.shape[1] / full_width if full_width else 1.)
+
+
+BACKENDS = {'cv2': Cv2Decoder(), 'pil': PilDecoder()}
+DEFAULT_PREFERENCES = {'JPEG': ['cv2', 'pil'], 'PNG': ['cv2', 'pil'], 'WEBP': ['cv2', 'pil'], None: ['pil']}
+preferences = dict(DEFAULT_PREFERENCES)
+stats = Counter()  # (格式, 后端): 解码次数
+_stats_lock = Lock()
+
+
+def configure(config=None):
+    """
+    设置各格式使用的后端及顺序，前面的后端解码失败时依次尝试后面的
+    :param config: {'JPEG': ['pil'], ...}，格式为sniff的返回值，None代表其它格式；
+        也可以是后端名的字符串，所有格式都优先使用它
+    :return:
+    """
+    preferences.clear()
+    preferences.update(DEFAULT_PREFERENCES)
+    if isinstance(config, str):
+        for fmt in preferences:
+            preferences[fmt] = [config] + [name for name in preferences[fmt] if name != config]
+    elif config:
+        preferences.update(config)
+
+
+def decode(fp, target_size=None, cancelled=None):
+    """
+    读取并解码图像，按格式依次尝试配置的后端，PIL作为最后的保底
+    :param fp: 文件名、fp或者bytes-like
+    :param target_size: [(w, h)]，给出时只解码够用的分辨率
+    :param cancelled: 返回True时放弃解码的函数
+    :return: (BGR的numpy数组, 相对原图的比例, 格式, 后端名)
+    """
+    data = read_bytes(fp)
+    check(cancelled)
+    fmt = sniff(data)
+    names = preferences.get(fmt, preferences[None])
+    if 'pil' not in names:
+        names = list(names) + ['pil']
+    for name in names:
+        try:
+            content, scale = BACKENDS[name].decode(data, target_size, cancelled)
+        except LoadCancelled:
+            raise
+        except Exception:
+            if name == names[-1]:
+                raise
+            log.debug('{} failed to decode {}, trying next backend'.format(name, fmt))
+            continue
+        with _stats_lock:
+            stats[(fmt, name)] += 1
+        return content, scale, fmt, name
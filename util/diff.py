@@ -0,0 +1,223 @@
+import logging
+from queue import Queue
+from threading import Thread
+from weakref import WeakValueDictionary
+
+import cv2
+import numpy as np
+import wx
+from pubsub import pub
+
+from util import trace
+from util.container import Container
+from util.imgloader import ImageLoader
+
+log = logging.getLogger('diff')
+log.setLevel(logging.ERROR)
+
+SIGNATURE_SIZE = 256  # 比较用的缩小图像的长边像素数
+DIFF_THRESHOLD = 24  # 任一通道相差超过多少算变化，高于JPEG压缩的噪声
+MIN_REGION = 3  # 变化区域最少的像素数（缩小后），更小的当作噪声
+GROUP_SIZE = 9  # 相距多少像素（缩小后）以内的变化算同一个区域，例如同一张脸上的眼睛和嘴
+MAX_CHANGED = 0.5  # 变化的面积超过这个比例时不是差分，不给出区域
+REGION_MARGIN = 0.15  # 跳转时在变化区域四周按区域尺寸留出的比例
+MIN_CROP = 0.05  # 跳转后裁剪范围的最小边长（比例）
+KERNEL = np.ones((GROUP_SIZE, GROUP_SIZE), np.uint8)
+
+
+class Changes(object):
+    """
+    两张相邻图像的比较结果，坐标都是相对于图像的比例，不受分辨率影响
+    """
+    __slots__ = ('mask', 'boxes', 'bbox', 'changed')
+
+    def __init__(self, mask, boxes, changed):
+        """
+        :param mask: 缩小后的变化掩码，bool数组
+        :param boxes: [(left, top, right, bottom)]变化的区域，按变化的像素数从多到少
+        :param changed: 变化的像素占的比例
+        """
+        self.mask = mask
+        self.boxes = boxes
+        self.changed = changed
+        if boxes:
+            self.bbox = (min(box[0] for box in boxes), min(box[1] for box in boxes),
+                         max(box[2] for box in boxes), max(box[3] for box in boxes))
+        else:
+            self.bbox = None
+
+    def crop(self, box=None, margin=REGION_MARGIN):
+        """
+        显示一个变化区域的裁剪比例，四周留出一些余量
+        :param box: boxes中的一个，默认为包含所有变化区域的bbox
+        :param margin: 按区域尺寸留出的比例
+        :return: (left, top, right, bottom)，没有变化时返回None
+        """
+        box = box if box is not None else self.bbox
+        if box is None:
+            return None
+        left, top, right, bottom = box
+        dx = max((right - left) * margin, (MIN_CROP - (right - left)) / 2, 0.)
+        dy = max((bottom - top) * margin, (MIN_CROP - (bottom - top)) / 2, 0.)
+        left, right = _inside(left - dx, right + dx)
+        top, bottom = _inside(top - dy, bottom + dy)
+        return left, top, right, bottom
+
+
+def _inside(low, high):
+    # 超出图像的部分移到另一边，靠近边缘的区域也保持原来的尺寸
+    shift = max(0., -low) - max(0., high - 1.)
+    return max(0., low + shift), min(1., high + shift)
+
+
+def signature(img: ImageLoader):
+    """
+    把图像缩小到长边SIGNATURE_SIZE用于比较，尺寸按原图计算，预览图和原图得到的结果可以互相比较
+    只使用已经生成的金字塔，不会为了比较解码或生成新的一级，结果保存在img.signature
+    :param img:
+    :return: BGR的numpy数组
+    """
+    if img.signature is None:
+        w, h = img.full_width, img.full_height
+        size = (max(1, round(w * SIGNATURE_SIZE / max(w, h))), max(1, round(h * SIGNATURE_SIZE / max(w, h))))
+        level = img.cached_level_for(size[0] / img.width)
+        img.signature = cv2.resize(level.content, size, interpolation=cv2.INTER_AREA)
+    return img.signature
+
+
+def compare(a, b):
+    """
+    逐像素比较两张缩小的图像，膨胀后按连通区域给出变化的范围
+    :param a: signature()的结果
+    :param b:
+    :return: Changes，尺寸不同（不是同一组差分）时返回None
+    """
+    if a.shape != b.shape:
+        return None
+    mask = cv2.absdiff(a, b).max(axis=2) > DIFF_THRESHOLD
+    changed = float(np.count_nonzero(mask)) / mask.size
+    boxes = []
+    if 0 < changed <= MAX_CHANGED:
+        h, w = mask.shape
+        # 膨胀后连在一起的变化算同一个区域，范围和像素数按膨胀前的掩码计算
+        grown = cv2.dilate(mask.view(np.uint8), KERNEL)
+        n, labels = cv2.connectedComponents(grown, connectivity=8)
+        labels[~mask] = 0
+        counts = np.bincount(labels.ravel(), minlength=n)
+        # 第0个是背景
+        for i in sorted(range(1, n), key=lambda i: -counts[i]):
+            if counts[i] >= MIN_REGION:
+                x, y, bw, bh = cv2.boundingRect((labels == i).view(np.uint8))
+                boxes.append((x / w, y / h, (x + bw) / w, (y + bh) / h))
+    return Changes(mask, boxes, changed)
+
+
+def rotate_crop(crop, turns):
+    """
+    把原图上的裁剪比例换算到顺时针旋转turns个90°之后的图像上
+    :param crop: (left, top, right, bottom)
+    :param turns:
+    :return:
+    """
+    for _ in range(turns % 4):
+        left, top, right, bottom = crop
+        crop = (1 - bottom, left, 1 - top, right)
+    return crop
+
+
+class DiffEngine(object):
+    """
+    图像进入缓存时，在后台线程中和img_list中相邻的、已经在缓存中的图像比较
+    只使用缓存中已经解码的图像，不会额外解码，结果保存在两张图像的ImageLoader.diffs里，随缓存一起淘汰
+    """
+
+    def __init__(self, container: Container, call_after=None):
+        """
+        :param container: 用来查找相邻的图像
+        :param call_after: 把结果交给主线程的函数，默认wx.CallAfter
+        """
+        self.container = container
+        self.call_after = call_after if call_after is not None else wx.CallAfter
+        self.images = WeakValueDictionary()  # key: 缓存中的ImageLoader，被淘汰后自动消失
+        self.queued = set()  # 尚未完成的比较，frozenset({key, 相邻的key})
+        self.jobs = Queue()
+        pub.subscribe(self.on_image_loaded, 'cache.image_loaded')
+        pub.subscribe(self.on_invalidate, 'cache.invalidate')
+        pub.subscribe(self.on_program_closed, 'program.closed')
+        self.thread = Thread(target=self.run, name='diff')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def on_image_loaded(self, msg):
+        """
+        记录进入缓存的图像，和已经在缓存中的相邻图像比较，比较过的不再重复
+        :param msg: (request,)
+        :return:
+        """
+        req = msg[0]
+        img = req.img
+        if img is None or img.content is None:
+            return
+        self.images[req.key] = img
+        pairs = []
+        idx = self.container.index_of(req.key)
+        if idx is not None:
+            for i in (idx - 1, idx + 1):
+                if not 0 <= i < len(self.container.img_list):
+                    continue
+                key = self.container.get_key(i)
+                other = self.images.get(key)
+                pair = frozenset((req.key, key))
+                if other is not None and key not in img.diffs and pair not in self.queued:
+                    self.queued.add(pair)
+                    pairs.append((key, other))
+        if pairs or img.signature is None:
+            # 相邻的图像还没有进入缓存时，也先准备好自己的signature
+            self.jobs.put((req.key, img, pairs))
+
+    def run(self):
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            key, img, pairs = job
+            try:
+                with trace.span('diff.signature', key=str(key)):
+                    a = signature(img)
+                for other_key, other in pairs:
+                    with trace.span('diff.compare', key=str(key), other=str(other_key)):
+                        changes = compare(a, signature(other))
+                    self.call_after(self._on_compared, key, img, other_key, other, changes)
+            except Exception as e:
+                log.error('{}: compare failed, {}'.format(key, e))
+            finally:
+                self.call_after(self._done, key, pairs)
+
+    def _done(self, key, pairs):
+        for other_key, _ in pairs:
+            self.queued.discard(frozenset((key, other_key)))
+
+    def _on_compared(self, key, img, other_key, other, changes):
+        # 在主线程中保存结果，期间被替换（更高的分辨率、文件被修改）的图像不再保存
+        if self.images.get(key) is img and self.images.get(other_key) is other:
+            img.diffs[other_key] = changes
+            other.diffs[key] = changes
+            if changes is not None:
+                log.info('{} -> {}: {:.2%} changed, {} regions'.format(key, other_key, changes.changed,
+                                                                       len(changes.boxes)))
+
+    def on_invalidate(self, msg):
+        """
+        文件被修改或删除后，去掉和它有关的比较结果
+        :param msg: (keys,)
+        :return:
+        """
+        keys = msg[0]
+        for key in keys:
+            self.images.pop(key, None)
+        for img in list(self.images.values()):
+            for key in keys:
+                img.diffs.pop(key, None)
+
+    def on_program_closed(self, msg):
+        self.jobs.put(None)
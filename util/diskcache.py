@@ -0,0 +1,177 @@
+import hashlib
+import logging
+import os
+import struct
+import sys
+import threading
+from pathlib import Path
+from threading import Lock
+
+import numpy as np
+
+log = logging.getLogger('diskcache')
+log.setLevel(logging.ERROR)
+
+DEFAULT_DISK_BUDGET = 4 * 1024 * 1024 * 1024  # 磁盘缓存的字节上限
+DEFAULT_SKIP_FORMATS = ('JPEG',)  # JPEG解码很快，还可以按DCT缩放，默认不存
+MAGIC = b'LSPRAW1\0'
+# 文件头：魔数，高，宽，通道数，格式，补齐到64字节后接着是连续存储的BGR数据
+HEADER = struct.Struct('<8s3I16s')
+HEADER_SIZE = 64
+SUFFIX = '.raw'
+
+
+def digest(key):
+    """
+    把container.get_disk_key返回的标识转换成固定长度的字符串，磁盘上的各种缓存都用它做key
+    :param key:
+    :return: str
+    """
+    return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+
+def cache_dir():
+    """
+    返回本程序的缓存目录，各种磁盘缓存都放在这里
+    :return: Path
+    """
+    if sys.platform == 'win32':
+        base = os.environ.get('LOCALAPPDATA') or Path.home() / 'AppData' / 'Local'
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache'
+    return Path(base) / 'LSP'
+
+
+class DiskCache(object):
+    """
+    把解码后的BGR数组存成可以直接内存映射的文件，重新打开文件夹或压缩文件时不用再解码
+    按文件的修改时间做LRU，命中时更新修改时间，超出上限时删除最久未使用的文件
+    """
+
+    def __init__(self, directory=None, budget=DEFAULT_DISK_BUDGET, skip_formats=DEFAULT_SKIP_FORMATS):
+        """
+        :param directory: 缓存目录，None时使用cache_dir()下的images
+        :param budget: 字节上限
+        :param skip_formats: 不存入的格式，为decoders.sniff的返回值
+        """
+        self.directory = Path(directory) if directory is not None else cache_dir() / 'images'
+        self.budget = budget
+        self.skip_formats = set(skip_formats or ())
+        self.lock = Lock()
+        self.entries = {}  # 文件名: (修改时间, 字节数)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.directory.mkdir(parents=True, exist_ok=True)
+        # 重启后从目录恢复各文件的使用时间和大小
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(SUFFIX):
+                st = entry.stat()
+                self.entries[entry.name] = (st.st_mtime, st.st_size)
+                self.nbytes += st.st_size
+            elif '.tmp' in entry.name:  # 上次没有写完的文件
+                self._remove(entry.name)
+
+    @staticmethod
+    def _name(key):
+        return digest(key) + SUFFIX
+
+    def get(self, key):
+        """
+        :param key: container.get_disk_key返回的稳定标识
+        :return: (只读的np.memmap, 格式)，没有时返回None
+        """
+        name = self._name(key)
+        path = self.directory / name
+        with self.lock:
+            if name not in self.entries:
+                self.misses += 1
+                return None
+        try:
+            with open(path, 'rb') as f:
+                magic, h, w, c, fmt = HEADER.unpack(f.read(HEADER.size))
+            if magic != MAGIC:
+                raise ValueError('bad header')
+            content = np.memmap(path, np.uint8, 'r', offset=HEADER_SIZE, shape=(h, w, c))
+            os.utime(path)
+        except (OSError, ValueError) as e:
+            log.info('{}: {}'.format(name, e))
+            with self.lock:
+                self._forget(name)
+                self.misses += 1
+            return None
+        with self.lock:
+            if name in self.entries:
+                self.entries[name] = (path.stat().st_mtime, self.entries[name][1])
+            self.hits += 1
+        return content, fmt.rstrip(b'\0').decode('ascii') or None
+
+    def put(self, key, content, fmt=None):
+        """
+        存入解码后的数组，先写临时文件再改名，其它线程不会读到写了一半的文件
+        :param key:
+        :param content: BGR的numpy数组
+        :param fmt: 格式，在skip_formats中时不存
+        :return: bool，是否存入
+        """
+        if fmt in self.skip_formats:
+            return False
+        name = self._name(key)
+        path = self.directory / name
+        size = HEADER_SIZE + content.nbytes
+        if size > self.budget:
+            return False
+        tmp = self.directory / '{}.tmp{}'.format(name, threading.get_ident())
+        h, w = content.shape[:2]
+        c = content.shape[2] if content.ndim > 2 else 1
+        header = HEADER.pack(MAGIC, h, w, c, (fmt or '').encode('ascii'))
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(header.ljust(HEADER_SIZE, b'\0'))
+                f.write(np.ascontiguousarray(content).data)
+            os.replace(tmp, path)
+        except OSError as e:
+            log.info('{}: {}'.format(name, e))
+            self._remove(tmp.name)
+            return False
+        with self.lock:
+            self._forget(name)
+            self.entries[name] = (path.stat().st_mtime, size)
+            self.nbytes += size
+            self._evict()
+        return True
+
+    def _evict(self):
+        # 超出上限时按使用时间从旧到新删除，正被映射的文件在windows下删不掉，跳过
+        if self.nbytes <= self.budget:
+            return
+        for name, (_, size) in sorted(self.entries.items(), key=lambda item: item[1][0]):
+            if self.nbytes <= self.budget:
+                break
+            if self._remove(name):
+                self._forget(name)
+
+    def _forget(self, name):
+        entry = self.entries.pop(name, None)
+        if entry is not None:
+            self.nbytes -= entry[1]
+
+    def _remove(self, name):
+        try:
+            os.remove(self.directory / name)
+            return True
+        except FileNotFoundError:
+            return True
+        except OSError:
+            return False
+
+    def clear(self):
+        with self.lock:
+            for name in list(self.entries):
+                if self._remove(name):
+                    self._forget(name)
+
+    def stats(self):
+        with self.lock:
+            return {'entries': len(self.entries), 'nbytes': self.nbytes, 'budget': self.budget,
+                    'hits': self.hits, 'misses': self.misses}
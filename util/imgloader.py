@@ -1,12 +1,17 @@
-from PIL import Image
-import pillow_avif
 import cv2
-import numpy as np
 import logging
+import math
+from collections import OrderedDict
+from threading import Lock
+from util import decoders
+from util.decoders import LoadCancelled
 
 logger = logging.getLogger('ImageLoader')
 logger.setLevel(logging.DEBUG)
 
+INTERMEDIATE_STEPS = 4  # 共享的中间结果在每两倍之间分几档比例
+INTERMEDIATE_LIMIT = 4  # 每张图像保留的中间结果个数
+
 
 class ImageLoader(object):
     """
@@ -15,19 +20,105 @@ class ImageLoader(object):
 
     def __init__(self):
         self.content = None
+        self.scale = 1.  # content相对原图的比例，小于1时是降低分辨率解码的预览图
+        self.format = None  # 解码时识别的格式
+        self.backend = None  # 解码使用的后端
+        self.levels = []  # 缩小到1/2,1/4...的金字塔，第一次用到时才生成
+        self._levels_lock = Lock()
+        self.intermediates = OrderedDict()  # (金字塔的宽, 裁剪范围, 比例档): 缩小后的裁剪部分，多个面板共用
+        self._intermediates_lock = Lock()
+        self.signature = None  # 和相邻图像比较用的缩小图像，见util.diff
+        self.diffs = {}  # 相邻图像的key: util.diff.Changes
         # self.bmp = None
 
-    def load_img(self, fp):
+    def load_img(self, fp, cancelled=None, target_size=None):
         """
-        读取图片并存储
+        读取图片并存储，按格式选择解码后端，见util.decoders
         :param fp: 普通文件夹里的文件名；或由container返回的压缩文件内的fp
+        :param cancelled: 返回True时放弃读取的函数，在每个阶段之间检查
+        :param target_size: [(w, h)]，各面板显示所需的尺寸范围，给出时JPEG按DCT缩放只解码够用的分辨率
         :return:
         """
-        img = Image.open(fp)
-        if not img.mode == 'RGB':
-            img = img.convert('RGB')
-        # 奇怪的是，windows设备的Bitmap居然也用的BGR格式？
-        self.content = cv2.cvtColor(np.asarray(img), cv2.COLOR_RGB2BGR)
+        self.content, self.scale, self.format, self.backend = decoders.decode(fp, target_size, cancelled)
+        self.levels = []
+        logger.debug('{} decoded by {}, scale {:.3f}'.format(self.format, self.backend, self.scale))
+
+    def load_raw(self, content, fmt=None, backend=None):
+        """
+        直接使用已经解码好的原图数组，例如磁盘缓存中映射的np.memmap
+        :param content: BGR的numpy数组
+        :param fmt: 原来识别的格式
+        :param backend: 数组的来源
+        :return:
+        """
+        self.set_img(content)
+        self.scale = 1.
+        self.format = fmt
+        self.backend = backend
+
+    required_scale = staticmethod(decoders.required_scale)
+
+    def satisfies(self, target_size):
+        """
+        当前分辨率是否足够显示
+        :param target_size: [(w, h)]，None表示需要原图
+        :return:
+        """
+        if self.scale >= 1:
+            return True
+        if target_size is None:
+            return False
+        # draft得到的尺寸是取整后的，留一点余量
+        return self.scale >= self.required_scale(target_size, self.full_width, self.full_height) * 0.99
+
+    def level_for(self, scale):
+        """
+        返回缩放到scale时可以使用的最小一级金字塔图像，细节仍然足够，缩放的开销只和输出尺寸有关
+        :param scale: 相对于content的缩放比例
+        :return: ImageLoader，scale大于1/2时就是自身
+        """
+        level = self
+        k = 1
+        while 0.5 ** k >= scale:
+            with self._levels_lock:
+                if len(self.levels) < k:
+                    # 由上一级缩小一半，太小的图像不再往下生成
+                    if level.width < 2 or level.height < 2:
+                        break
+                    half = ImageLoader()
+                    half.set_img(cv2.resize(level.content, (level.width // 2, level.height // 2),
+                                            interpolation=cv2.INTER_AREA))
+                    self.levels.append(half)
+                level = self.levels[k - 1]
+            k += 1
+        return level
+
+    def cached_level_for(self, scale):
+        """
+        和level_for相同，但只使用已经生成的金字塔，不会临时生成新的一级，用于交互过程中的快速渲染
+        :param scale: 相对于content的缩放比例
+        :return: ImageLoader
+        """
+        level = self
+        with self._levels_lock:
+            for k, half in enumerate(self.levels, 1):
+                if 0.5 ** k < scale:
+                    break
+                level = half
+        return level
+
+    @property
+    def nbytes(self):
+        # 图像及已生成的金字塔、中间结果、差分比较结果占用的字节数
+        # 比较结果由相邻的两张图像共用，两边都计算，淘汰其中一张后另一张仍然持有
+        if self.content is None:
+            return 0
+        with self._intermediates_lock:
+            shared = sum(img.content.nbytes for img in self.intermediates.values())
+        if self.signature is not None:
+            shared += self.signature.nbytes
+        shared += sum(changes.mask.nbytes for changes in list(self.diffs.values()) if changes is not None)
+        return self.content.nbytes + sum(level.content.nbytes for level in self.levels) + shared
 
     def get_img(self):
         """
@@ -42,6 +133,47 @@ class ImageLoader(object):
         :return:
         """
         self.content = content
+        self.levels = []
+        self.intermediates = OrderedDict()
+        self.signature = None
+        self.diffs = {}
+
+    def resample(self, crop, scale, size, fast=False):
+        """
+        裁剪并缩放到size，缩小时先把裁剪部分缩小到按档取整的比例，作为中间结果保存，
+        其它面板显示同一裁剪、比例相近时共用这次开销大的缩小，只需要再做一次很小的缩放
+        :param crop: 裁剪比例(left, top, right, bottom)
+        :param scale: 相对于content的缩放比例，用来选择金字塔
+        :param size: 输出尺寸(w, h)
+        :param fast: 交互过程中的快速渲染，只使用已有的中间结果
+        :return: ImageLoader，可能是共用的中间结果，只能读取
+        """
+        level = self.cached_level_for(scale) if fast else self.level_for(scale)
+        box = (int(crop[0] * level.width), int(crop[1] * level.height),
+               int(crop[2] * level.width), int(crop[3] * level.height))
+        width, height = box[2] - box[0], box[3] - box[1]
+        if size[0] >= width or size[1] >= height:
+            # 放大时输出的尺寸就是开销，没有可以共用的部分
+            return level.crop(box).resize(size, fast=fast)
+        # 向上取到档位，中间结果不小于输出，最后一步只会缩小
+        ratio = 2 ** (math.ceil(math.log2(size[0] / width) * INTERMEDIATE_STEPS) / INTERMEDIATE_STEPS)
+        key = (level.width, box, ratio)
+        with self._intermediates_lock:
+            inter = self.intermediates.get(key)
+            if inter is not None:
+                self.intermediates.move_to_end(key)
+        if inter is None:
+            if fast:
+                return level.crop(box).resize(size, fast=True)
+            inter = level.crop(box).resize((max(size[0], round(width * ratio)), max(size[1], round(height * ratio))))
+            with self._intermediates_lock:
+                self.intermediates[key] = inter
+                while len(self.intermediates) > INTERMEDIATE_LIMIT:
+                    self.intermediates.popitem(last=False)
+        if (inter.width, inter.height) == tuple(size):
+            return inter
+        # 中间结果和输出相差不到一档，线性插值就足够，不会有混叠
+        return inter.resize(size, fast=True)
 
     def crop(self, crop_rect: tuple):
         """
@@ -53,15 +185,18 @@ class ImageLoader(object):
         cropped_img.set_img(self.content[crop_rect[1]:crop_rect[3], crop_rect[0]:crop_rect[2]])
         return cropped_img
 
-    def resize(self, size: tuple, flip_code=0):
+    def resize(self, size: tuple, flip_code=None, fast=False):
         """
-        缩放并翻转，这是由于numpy数组转换到Bitmap时会上下翻转图像的问题
-        :param flip_code: 0为默认，上下翻转，传递None不翻转
+        缩放，绘制后端直接使用从上到下存储的数组，默认不再翻转
+        :param flip_code: 给出时按cv2.flip的参数翻转，0为上下翻转
         :param size: (width,height)
+        :param fast: 交互过程中使用的快速插值，放大两倍以上用最近邻，其它用线性
         :return:
         """
         resized_img = ImageLoader()
-        if self.width < size[0]:  # 放大
+        if fast:
+            mode = cv2.INTER_NEAREST if size[0] >= 2 * self.width else cv2.INTER_LINEAR
+        elif self.width < size[0]:  # 放大
             # mode = cv2.INTER_LINEAR
             mode = cv2.INTER_CUBIC
         else:
@@ -79,6 +214,9 @@ class ImageLoader(object):
         :return:
         """
         rotated_img = ImageLoader()
+        rotated_img.scale = self.scale
+        rotated_img.format = self.format
+        rotated_img.backend = self.backend
         if direction == 1:
             rotated_img.set_img(cv2.rotate(self.content, cv2.ROTATE_90_CLOCKWISE))
         elif direction == -1:
@@ -98,3 +236,12 @@ class ImageLoader(object):
             return self.content.shape[0]
         else:
             return 0
+
+    @property
+    def full_width(self):
+        # 原图的宽度，预览图按比例换算
+        return int(round(self.width / self.scale))
+
+    @property
+    def full_height(self):
+        return int(round(self.height / self.scale))
@@ -0,0 +1,77 @@
+from collections import OrderedDict
+
+
+class ByteLRU(object):
+    """
+    按字节数限制容量的LRU，基于OrderedDict，查找、插入和淘汰都是O(1)
+    至少保留最近插入的一项，哪怕单项就超出了预算
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.items = OrderedDict()  # key: (value, nbytes)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        """
+        查找并将该项移到最近使用的位置，同时更新命中计数
+        """
+        try:
+            value, _ = self.items[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.items.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def peek(self, key, default=None):
+        """
+        查找但不改变顺序和计数
+        """
+        try:
+            return self.items[key][0]
+        except KeyError:
+            return default
+
+    def put(self, key, value, nbytes):
+        """
+        插入或替换一项，超出预算时从最久未使用的一端淘汰
+        :return: 被淘汰的(key, value)列表
+        """
+        old = self.items.pop(key, None)
+        if old is not None:
+            self.nbytes -= old[1]
+        self.items[key] = (value, nbytes)
+        self.nbytes += nbytes
+        evicted = []
+        while self.nbytes > self.budget and len(self.items) > 1:
+            old_key, (old_value, old_nbytes) = self.items.popitem(last=False)
+            self.nbytes -= old_nbytes
+            self.evictions += 1
+            evicted.append((old_key, old_value))
+        return evicted
+
+    def pop(self, key, default=None):
+        old = self.items.pop(key, None)
+        if old is None:
+            return default
+        self.nbytes -= old[1]
+        return old[0]
+
+    def clear(self):
+        self.items.clear()
+        self.nbytes = 0
+
+    def stats(self):
+        return {'entries': len(self.items), 'nbytes': self.nbytes, 'budget': self.budget,
+                'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
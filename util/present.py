@@ -0,0 +1,265 @@
+import ctypes
+import logging
+import sys
+from collections import OrderedDict
+from ctypes import c_ubyte, c_void_p, byref, sizeof
+from ctypes.wintypes import WORD, DWORD, LONG
+from threading import Lock
+
+import cv2
+import numpy as np
+import wx
+
+try:
+    import win32api
+    import win32con
+    import win32gui
+except ImportError:  # 非Windows平台只能使用wx绘制
+    win32api = win32con = win32gui = None
+
+log = logging.getLogger('present')
+log.setLevel(logging.ERROR)
+
+HEADER_CACHE_SIZE = 32  # 缓存的位图信息结构个数，同一尺寸只生成一次
+MAX_DAMAGE_RECTS = 16  # 更新区域由太多矩形组成时，改为绘制它们的外接矩形
+
+
+class RGBQUAD(ctypes.Structure):
+    _fields_ = [
+        ('rgbRed', c_ubyte),
+        ('rgbGreen', c_ubyte),
+        ('rgbBlue', c_ubyte),
+        ('rgbReserved', c_ubyte)
+    ]
+
+
+class BITMAPINFOHEADER(ctypes.Structure):
+    _fields_ = [
+        ('biSize', DWORD),
+        ('biWidth', LONG),
+        ('biHeight', LONG),  # 负数表示从上到下存储
+        ('biPlanes', WORD),  # 1
+        ('biBitCount', WORD),  # 24
+        ('biCompression', DWORD),  # BI_RGB = 0 for uncompressed format
+        ('biSizeImage', DWORD),  # 0
+        ('biXPelsPerMeter', LONG),  # 0
+        ('biYPelsPerMeter', LONG),  # 0
+        ('biClrUsed', DWORD),  # 0
+        ('biClrImportant', DWORD)  # 0
+    ]
+
+
+class BITMAPINFO(ctypes.Structure):
+    _fields_ = [
+        ('bmiHeader', BITMAPINFOHEADER),
+        ('bmiColors', RGBQUAD * 1)  # 24位位图不使用调色板
+    ]
+
+
+class Surface(object):
+    """
+    可以直接绘制的位图数据，由Presenter.prepare在渲染线程中生成，绘制时只读取
+    """
+
+    def __init__(self, buffer, width, height, header=None):
+        """
+        :param buffer: 从上到下存储的numpy数组，持有它保证数据指针有效
+        :param width: 图像的宽度，buffer每行可能有补齐的字节
+        :param height:
+        :param header: Win32绘制用的位图信息结构
+        """
+        self.buffer = buffer
+        self.width = width
+        self.height = height
+        self.header = header
+        self.bits = buffer.ctypes.data_as(c_void_p) if header is not None else None
+        self.bitmap = None  # wx绘制时在主线程中第一次绘制时生成
+
+
+class Presenter(object):
+    """
+    把渲染结果绘制到面板上，prepare在渲染线程中调用，paint在主线程的OnPaint中调用
+    """
+    name = None
+
+    def prepare(self, content):
+        """
+        :param content: BGR的numpy数组，从上到下存储
+        :return: Surface
+        """
+        raise NotImplementedError
+
+    def paint(self, window, surface: Surface, x, y, select_box=None):
+        """
+        只绘制面板更新区域内的部分
+        :param window: 要绘制的面板
+        :param surface: prepare的结果
+        :param x: 左上角在面板中的位置
+        :param y:
+        :param select_box: (left, top, width, height)，需要画出的选框
+        :return:
+        """
+        raise NotImplementedError
+
+    @staticmethod
+    def damage(window, surface: Surface, x, y):
+        """
+        把面板的更新区域和图像的范围求交集，OnPaint中调用
+        :return: [(面板中的left, top, width, height, 图像中的left, top)]
+        """
+        region = window.GetUpdateRegion()
+        rects = []
+        it = wx.RegionIterator(region)
+        while it.HaveRects():
+            rects.append(it.GetRect())
+            if len(rects) > MAX_DAMAGE_RECTS:
+                rects = [region.GetBox()]
+                break
+            it.Next()
+        parts = []
+        for rect in rects:
+            left, top = max(rect.x, x), max(rect.y, y)
+            right = min(rect.x + rect.width, x + surface.width)
+            bottom = min(rect.y + rect.height, y + surface.height)
+            if right > left and bottom > top:
+                parts.append((left, top, right - left, bottom - top, left - x, top - y))
+        return parts
+
+
+class Win32Presenter(Presenter):
+    """
+    用StretchDIBits绘制，位图信息的高度为负数，numpy数组从上到下存储，不用翻转
+    """
+    name = 'win32'
+
+    def __init__(self):
+        self.headers = OrderedDict()  # (w, h): BITMAPINFO
+        self.lock = Lock()
+
+    def header(self, width, height):
+        """
+        返回对应尺寸的位图信息结构，同一尺寸只生成一次
+        :return: BITMAPINFO
+        """
+        with self.lock:
+            bmi = self.headers.pop((width, height), None)
+            if bmi is None:
+                bmi = BITMAPINFO(BITMAPINFOHEADER(sizeof(BITMAPINFOHEADER), width, -height,
+                                                  1, 24, 0, 0, 0, 0, 0, 0))
+            self.headers[(width, height)] = bmi
+            if len(self.headers) > HEADER_CACHE_SIZE:
+                self.headers.popitem(last=False)
+            return bmi
+
+    def prepare(self, content):
+        height, width = content.shape[:2]
+        # DIB每行按4字节对齐，宽度不是4的整数倍或者数组不连续时才复制一次
+        stride = (width * 3 + 3) // 4 * 4
+        if stride == width * 3 and content.flags['C_CONTIGUOUS']:
+            buffer = content
+        else:
+            buffer = np.zeros((height, stride), np.uint8)
+            buffer[:, :width * 3] = content.reshape(height, width * 3)
+        return Surface(buffer, width, height, self.header(width, height))
+
+    def paint(self, window, surface: Surface, x, y, select_box=None):
+        parts = self.damage(window, surface, x, y)
+        handle = window.GetHandle()
+        # 该段直接在copy位图前才生成dc，避免窗口闪动
+        dc, ps = win32gui.BeginPaint(handle)
+        win32gui.SetStretchBltMode(dc, win32con.COLORONCOLOR)
+        stride = surface.buffer.strides[0]
+        for left, top, width, height, src_x, src_y in parts:
+            # 数据指针移到第src_y行，位图信息的高度只包括要绘制的行，
+            # 源矩形在纵向上覆盖整个位图，避免从上到下存储时纵坐标的歧义
+            ctypes.windll.gdi32.StretchDIBits(dc, left, top, width, height,
+                                              src_x, 0, width, height,
+                                              c_void_p(surface.buffer.ctypes.data + src_y * stride),
+                                              byref(self.header(surface.width, height)),
+                                              win32con.DIB_RGB_COLORS,
+                                              win32con.SRCCOPY)
+        if select_box is not None:
+            left, top, width, height = select_box
+            if width > 1 and height > 1:
+                # 右下角减1的原因：传过来的更新区域是以select_box为基础的rect，不画在更新区域内的话无法抹掉
+                right, bottom = left + width - 1, top + height - 1
+                pen = win32gui.CreatePen(win32con.PS_DOT, 1, win32api.RGB(0, 255, 0))
+                win32gui.SelectObject(dc, pen)
+                win32gui.MoveToEx(dc, left, top)
+                win32gui.BeginPath(dc)
+                win32gui.LineTo(dc, right, top)
+                win32gui.LineTo(dc, right, bottom)
+                win32gui.LineTo(dc, left, bottom)
+                win32gui.LineTo(dc, left, top)
+                win32gui.EndPath(dc)
+                win32gui.StrokePath(dc)
+        win32gui.EndPaint(handle, ps)
+
+
+class WxPresenter(Presenter):
+    """
+    用wx.PaintDC绘制，各平台通用
+    wx.Bitmap.FromBuffer需要RGB顺序，在渲染线程中转换好，主线程只从这块数据生成位图
+    """
+    name = 'wx'
+
+    def prepare(self, content):
+        height, width = content.shape[:2]
+        return Surface(cv2.cvtColor(content, cv2.COLOR_BGR2RGB), width, height)
+
+    def paint(self, window, surface: Surface, x, y, select_box=None):
+        # GDI对象不能跨线程使用，位图在主线程中生成，之后重绘直接使用
+        if surface.bitmap is None:
+            surface.bitmap = wx.Bitmap.FromBuffer(surface.width, surface.height, surface.buffer)
+        parts = self.damage(window, surface, x, y)
+        dc = wx.PaintDC(window)
+        if parts:
+            mdc = wx.MemoryDC(surface.bitmap)
+            for left, top, width, height, src_x, src_y in parts:
+                dc.Blit(left, top, width, height, mdc, src_x, src_y)
+            mdc.SelectObject(wx.NullBitmap)
+        if select_box is not None:
+            left, top, width, height = select_box
+            if width > 1 and height > 1:
+                dc.SetPen(wx.Pen(wx.Colour(0, 255, 0), 1, wx.PENSTYLE_DOT))
+                dc.SetBrush(wx.TRANSPARENT_BRUSH)
+                dc.DrawRectangle(left, top, width, height)
+
+
+BACKENDS = {cls.name: cls for cls in (Win32Presenter, WxPresenter)}
+presenter = None
+
+
+def available():
+    """
+    :return: 当前平台可以使用的后端名
+    """
+    names = ['wx']
+    if win32gui is not None and sys.platform == 'win32':
+        names.insert(0, 'win32')
+    return names
+
+
+def configure(name=None):
+    """
+    选择绘制使用的后端
+    :param name: 'win32'或'wx'，None或者当前平台不支持时自动选择
+    :return:
+    """
+    global presenter
+    names = available()
+    if name not in names:
+        if name is not None:
+            log.error('presenter {} not available, using {}'.format(name, names[0]))
+        name = names[0]
+    presenter = BACKENDS[name]()
+
+
+def get_presenter():
+    """
+    返回当前的绘制后端，没有配置过时自动选择
+    :return: Presenter
+    """
+    if presenter is None:
+        configure()
+    return presenter
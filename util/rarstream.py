@@ -0,0 +1,148 @@
+import logging
+import subprocess
+import sys
+import tempfile
+from threading import Thread, Condition
+
+import rarfile
+
+from util.decoders import LoadCancelled
+
+log = logging.getLogger('rarstream')
+log.setLevel(logging.ERROR)
+
+SPOOL_BUDGET = 256 * 1024 * 1024  # 解压出的图像放在内存中的字节上限，超出的部分写到临时文件
+CHUNK_SIZE = 1024 * 1024  # 跳过不需要的文件时每次读取的字节数
+WAIT_INTERVAL = 0.1  # 等待解压时检查是否取消的间隔
+
+
+class RarStream(object):
+    """
+    固实压缩的rar随机读取一个文件时要解压它前面的所有文件，逐个读取整个压缩文件的开销是O(n²)
+    这里只启动一个unrar进程，按压缩文件中的顺序一次性把所有文件输出到stdout，
+    需要的图像按大小切分后放到内存或临时文件中，之后的读取和随机跳转都直接使用已经解压的数据
+    """
+
+    def __init__(self, path, order, wanted, budget=SPOOL_BUDGET):
+        """
+        :param path: 压缩文件路径
+        :param order: [(文件名, 大小)]，压缩文件中的顺序，与unrar输出的顺序一致
+        :param wanted: 需要保留的文件名
+        :param budget: 内存中保留的字节上限
+        """
+        self.path = path
+        self.order = order
+        self.positions = {name: i for i, (name, _) in enumerate(order)}
+        self.wanted = set(wanted)
+        self.budget = budget
+        self.ram = {}  # 文件名: bytes
+        self.ram_bytes = 0
+        self.spool = None  # 临时文件
+        self.spooled = {}  # 文件名: (偏移, 大小)
+        self.position = 0  # 已经解压到第几个文件
+        self.finished = False
+        self.error = None
+        self.closed = False
+        self.cond = Condition()
+        self.process = None
+        self.thread = None
+
+    def _start(self):
+        # 第一次读取时才启动解压进程
+        flags = subprocess.CREATE_NO_WINDOW if sys.platform == 'win32' else 0
+        try:
+            self.process = subprocess.Popen([rarfile.UNRAR_TOOL, 'p', '-inul', '-y', str(self.path)],
+                                            stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                                            stderr=subprocess.DEVNULL, creationflags=flags)
+        except OSError as e:  # 找不到unrar
+            self.error = e
+            self.finished = True
+            return
+        self.thread = Thread(target=self.run, name='rar-stream')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def read(self, name, cancelled=None):
+        """
+        返回文件的内容，还没有解压到时等待
+        :param name: 压缩文件中的文件名
+        :param cancelled: 返回True时放弃等待的函数
+        :return: bytes
+        """
+        if name not in self.positions or name not in self.wanted:
+            raise KeyError(name)
+        with self.cond:
+            if self.process is None and not self.finished:
+                self._start()
+            while self.position <= self.positions[name] and not self.finished:
+                if cancelled is not None and cancelled():
+                    raise LoadCancelled()
+                self.cond.wait(WAIT_INTERVAL)
+            if name in self.ram:
+                return self.ram[name]
+            if name in self.spooled:
+                offset, size = self.spooled[name]
+                self.spool.seek(offset)
+                return self.spool.read(size)
+        raise IOError('{}: {} not extracted, {}'.format(self.path, name, self.error))
+
+    def run(self):
+        stdout = self.process.stdout
+        try:
+            for i, (name, size) in enumerate(self.order):
+                if name in self.wanted:
+                    data = stdout.read(size)
+                    if len(data) != size:
+                        raise IOError('unexpected end of stream at {}'.format(name))
+                    self._store(name, data)
+                else:
+                    while size > 0:
+                        skipped = len(stdout.read(min(size, CHUNK_SIZE)))
+                        if skipped == 0:
+                            raise IOError('unexpected end of stream at {}'.format(name))
+                        size -= skipped
+                with self.cond:
+                    if self.closed:
+                        return
+                    self.position = i + 1
+                    self.cond.notify_all()
+        except Exception as e:
+            log.error('{}: {}'.format(self.path, e))
+            self.error = e
+        finally:
+            with self.cond:
+                self.finished = True
+                self.cond.notify_all()
+            stdout.close()
+            self.process.wait()
+
+    def _store(self, name, data):
+        with self.cond:
+            if self.closed:
+                return
+            if self.ram_bytes + len(data) <= self.budget:
+                self.ram[name] = data
+                self.ram_bytes += len(data)
+            else:
+                if self.spool is None:
+                    self.spool = tempfile.TemporaryFile(prefix='lsp-')
+                self.spool.seek(0, 2)
+                self.spooled[name] = (self.spool.tell(), len(data))
+                self.spool.write(data)
+
+    def close(self):
+        """
+        结束解压进程，释放内存和临时文件
+        :return:
+        """
+        with self.cond:
+            self.closed = True
+            self.finished = True
+            self.cond.notify_all()
+            if self.process is not None and self.process.poll() is None:
+                self.process.kill()
+            self.ram.clear()
+            if self.spool is not None:
+                self.spool.close()
+                self.spool = None
+            self.spooled.clear()
@@ -0,0 +1,127 @@
+import logging
+from collections import OrderedDict
+from threading import Thread, Condition
+
+import wx
+
+from util import trace
+from util.imgloader import ImageLoader
+from util.present import Presenter
+
+log = logging.getLogger('render')
+log.setLevel(logging.ERROR)
+
+
+class RenderJob(object):
+    """
+    画布一次渲染需要的全部状态，在主线程生成，提交后不再修改
+    """
+
+    def __init__(self, canvas, seq, img: ImageLoader, crop, scale, size, view, origin, presenter: Presenter,
+                 tiled=False, cid=None, fast=False):
+        """
+        :param canvas: 提交渲染的画布，同一画布只保留最新的任务
+        :param seq: 画布内递增的序号，旧任务的结果不会覆盖新任务的结果
+        :param img: 源图像
+        :param crop: 裁剪比例
+        :param scale: 相对于源图像的缩放比例
+        :param size: 裁剪部分缩放后整张图像的尺寸(w, h)
+        :param view: 要渲染的范围(left, top, right, bottom)
+        :param origin: 提交时缩放后图像左上角在面板中的位置(left, top)
+        :param presenter: 绘制后端，决定结果的数据格式
+        :param tiled: 是否分块渲染
+        :param cid: 追踪用的关联id，见util.trace
+        :param fast: 交互过程中的快速渲染，之后会用高质量重新渲染
+        """
+        self.canvas = canvas
+        self.seq = seq
+        self.img = img
+        self.crop = crop
+        self.scale = scale
+        self.size = size
+        self.view = view
+        self.origin = origin
+        self.presenter = presenter
+        self.tiled = tiled
+        self.cid = cid
+        self.fast = fast
+
+
+class Frame(object):
+    """
+    渲染完成的结果，包括要绘制的图像和绘制后端需要的数据，绘制时只读取不修改
+    """
+
+    def __init__(self, job: RenderJob, img: ImageLoader):
+        self.seq = job.seq
+        self.img = img
+        self.size = job.size
+        self.view = job.view
+        self.origin = job.origin
+        self.fast = job.fast
+        self.surface = job.presenter.prepare(img.content)
+
+
+def render(job: RenderJob):
+    """
+    按任务裁剪缩放源图像，生成可以直接绘制的结果
+    :param job:
+    :return: Frame
+    """
+    if job.tiled:
+        zoomed_img = ImageLoader()
+        zoomed_img.set_img(job.canvas.tiles.render(job.img, job.crop, job.size, job.view, job.fast))
+    else:
+        # 像素从细节足够的最小一级金字塔裁剪，缩小的开销只和输出尺寸有关
+        # 快速渲染时不临时生成金字塔，用已有的最接近的一级；裁剪相同、比例相近的面板共用缩小的中间结果
+        zoomed_img = job.img.resample(job.crop, job.scale, job.size, job.fast)
+    return Frame(job, zoomed_img)
+
+
+class RenderWorker(object):
+    """
+    渲染线程，各画布的任务按提交顺序处理，同一画布未开始的任务只保留最新的一个
+    结果通过wx.CallAfter交给画布的on_rendered，在主线程中整体替换
+    """
+
+    def __init__(self):
+        self.jobs = OrderedDict()  # canvas: 等待处理的任务
+        self.cond = Condition()
+        self.thread = Thread(target=self.run, name='render-worker')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, job: RenderJob):
+        with self.cond:
+            # 先删除再插入，被替换的画布排到队尾，避免一直拖动的面板占住渲染线程
+            self.jobs.pop(job.canvas, None)
+            self.jobs[job.canvas] = job
+            self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.jobs:
+                    self.cond.wait()
+                _, job = self.jobs.popitem(last=False)
+            try:
+                with trace.span('render', job.cid, panel=job.canvas.info.name, tiled=job.tiled, fast=job.fast):
+                    frame = render(job)
+            except Exception:
+                log.exception('render failed')
+                continue
+            wx.CallAfter(job.canvas.on_rendered, frame)
+
+
+_worker = None
+
+
+def get_worker():
+    """
+    返回所有画布共用的渲染线程，第一次调用时启动
+    :return: RenderWorker
+    """
+    global _worker
+    if _worker is None:
+        _worker = RenderWorker()
+    return _worker
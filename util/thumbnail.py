@@ -0,0 +1,169 @@
+import logging
+import sqlite3
+import time
+from collections import OrderedDict
+from threading import Thread, Condition, Lock
+
+import cv2
+import numpy as np
+import wx
+from pubsub import pub
+
+from util import decoders
+from util.decoders import LoadCancelled
+from util.diskcache import cache_dir, digest
+
+log = logging.getLogger('thumbnail')
+log.setLevel(logging.ERROR)
+
+THUMB_SIZE = 64  # 缩略图的边长
+THUMB_QUALITY = 85  # 存入数据库时JPEG的压缩质量
+DEFAULT_THUMB_LIMIT = 100000  # 数据库中最多保留的缩略图数
+PENDING_LIMIT = 256  # 等待生成的缩略图数，超出时丢弃最早的请求，即已经滚动过去的行
+CLOSE_TIMEOUT = 2.  # 关闭程序时最多等待后台线程多少秒
+
+
+class ThumbnailDB(object):
+    """
+    缩略图数据库，用sqlite存储JPEG编码的缩略图，key与磁盘缓存相同
+    """
+
+    def __init__(self, path=None, limit=DEFAULT_THUMB_LIMIT):
+        """
+        :param path: 数据库文件，None时使用cache_dir()下的thumbnails.db
+        :param limit: 最多保留的缩略图数，关闭时删除最早生成的
+        """
+        if path is None:
+            cache_dir().mkdir(parents=True, exist_ok=True)
+            path = cache_dir() / 'thumbnails.db'
+        self.limit = limit
+        self.lock = Lock()
+        self.conn = sqlite3.connect(str(path), check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS thumbs '
+                          '(key TEXT PRIMARY KEY, created REAL, data BLOB)')
+        self.conn.commit()
+
+    def get(self, key):
+        """
+        :param key: container.get_disk_key返回的标识
+        :return: BGR的numpy数组，没有时返回None
+        """
+        with self.lock:
+            row = self.conn.execute('SELECT data FROM thumbs WHERE key=?', (digest(key),)).fetchone()
+        if row is None:
+            return None
+        return cv2.imdecode(np.frombuffer(row[0], np.uint8), cv2.IMREAD_COLOR)
+
+    def put(self, key, thumb):
+        ok, data = cv2.imencode('.jpg', thumb, [cv2.IMWRITE_JPEG_QUALITY, THUMB_QUALITY])
+        if not ok:
+            return
+        with self.lock:
+            self.conn.execute('INSERT OR REPLACE INTO thumbs VALUES (?, ?, ?)',
+                              (digest(key), time.time(), data.tobytes()))
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.execute('DELETE FROM thumbs WHERE key IN '
+                              '(SELECT key FROM thumbs ORDER BY created DESC LIMIT -1 OFFSET ?)', (self.limit,))
+            self.conn.commit()
+            self.conn.close()
+
+
+def make_thumbnail(fp, size=THUMB_SIZE):
+    """
+    解码并缩小到size以内，JPEG只解码够用的分辨率
+    :param fp: 文件名或fp
+    :param size: 边长
+    :return: BGR的numpy数组
+    """
+    content = decoders.decode(fp, [(size, size)])[0]
+    h, w = content.shape[:2]
+    ratio = min(size / w, size / h, 1.)
+    return cv2.resize(content, (max(1, int(w * ratio)), max(1, int(h * ratio))), interpolation=cv2.INTER_AREA)
+
+
+class ThumbnailPool(object):
+    """
+    在后台生成缩略图的线程，优先处理最近请求的，即当前可见的行
+    只用一个线程，JPEG按DCT缩放解码，尽量不和图像缓存的解码线程抢资源
+    结果通过wx.CallAfter交给请求时给出的回调函数
+    """
+
+    def __init__(self, settings=None):
+        self.settings = settings if settings is not None else {}
+        self.size = self.settings.get('thumb_size', THUMB_SIZE)
+        try:
+            self.db = ThumbnailDB(self.settings.get('thumb_db'))
+        except (OSError, sqlite3.Error) as e:
+            log.error('thumbnail database disabled: {}'.format(e))
+            self.db = None
+        self.pending = OrderedDict()  # key: (source, callback, disk_key)
+        self.cond = Condition()
+        self.closed = False
+        self.thread = Thread(target=self.run, name='thumbnail-worker')
+        self.thread.daemon = True
+        self.thread.start()
+        pub.subscribe(self.on_program_closed, 'program.closed')
+
+    def request(self, key, source, callback, disk_key=None):
+        """
+        由主线程调用，重复的请求移到最前
+        :param key: container.get_key返回的标识
+        :param source: 文件名，或者打开fp的函数
+        :param callback: callback(key, thumb)，在主线程中调用，无法生成缩略图时thumb为None
+        :param disk_key: 数据库用的标识，或者container.get_disk_key_source返回的函数，在后台线程中调用；
+            None时不使用数据库
+        :return:
+        """
+        with self.cond:
+            self.pending.pop(key, None)
+            self.pending[key] = (source, callback, disk_key)
+            while len(self.pending) > PENDING_LIMIT:
+                self.pending.popitem(last=False)
+            self.cond.notify()
+
+    def clear(self):
+        with self.cond:
+            self.pending.clear()
+
+    def on_program_closed(self, msg):
+        with self.cond:
+            self.closed = True
+            self.pending.clear()
+            self.cond.notify()
+        # 读取已经放弃等待，只剩正在进行的一次解码
+        self.thread.join(CLOSE_TIMEOUT)
+        if self.thread.is_alive():
+            log.error('thumbnail worker still busy, database left open')
+        elif self.db is not None:
+            self.db.close()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+                if self.closed:
+                    return
+                key, (source, callback, disk_key) = self.pending.popitem()
+            if self.db is None:
+                disk_key = None
+            elif callable(disk_key):
+                disk_key = disk_key()
+            thumb = self.db.get(disk_key) if disk_key is not None else None
+            if thumb is None:
+                try:
+                    # 固实压缩文件要等解压到这个文件，关闭程序时放弃等待
+                    fp = source(lambda: self.closed) if callable(source) else source
+                    thumb = make_thumbnail(fp, self.size)
+                except LoadCancelled:
+                    continue
+                except Exception as e:
+                    log.info('{}: {}'.format(key, e))
+                    wx.CallAfter(callback, key, None)
+                    continue
+                if disk_key is not None:
+                    self.db.put(disk_key, thumb)
+            wx.CallAfter(callback, key, thumb)
@@ -0,0 +1,99 @@
+import math
+import cv2
+import numpy as np
+from util.imgloader import ImageLoader
+from util.lru import ByteLRU
+
+TILE_SIZE = 256  # 块的边长，宽度*3是4的整数倍，拼接后的位图不用补齐
+DEFAULT_TILE_BUDGET = 64 * 1024 * 1024  # 每个画布缓存已渲染块的字节上限
+
+
+class TileRenderer(object):
+    """
+    把缩放后的整张图像看作按TILE_SIZE划分的块，只渲染可见区域覆盖的块
+    最近渲染的块放在LRU中，平移时只需要补上新露出来的块
+    """
+
+    def __init__(self, budget=DEFAULT_TILE_BUDGET):
+        self.tiles = ByteLRU(budget)
+        self._img = None  # 块所属的源图像
+
+    @staticmethod
+    def align(view, size):
+        """
+        把可见区域扩展到块的边界
+        :param view: (left, top, right, bottom)，缩放后图像的坐标
+        :param size: 缩放后图像的尺寸(w, h)
+        :return: (left, top, right, bottom)
+        """
+        return (view[0] // TILE_SIZE * TILE_SIZE,
+                view[1] // TILE_SIZE * TILE_SIZE,
+                min(size[0], math.ceil(view[2] / TILE_SIZE) * TILE_SIZE),
+                min(size[1], math.ceil(view[3] / TILE_SIZE) * TILE_SIZE))
+
+    def render(self, img: ImageLoader, crop, size, view, fast=False):
+        """
+        拼接出缩放后图像中view区域的像素
+        :param img: 源图像
+        :param crop: 裁剪比例
+        :param size: 裁剪部分缩放后的尺寸(w, h)
+        :param view: 已对齐到块边界的区域(left, top, right, bottom)
+        :param fast: 交互过程中的快速渲染，只用已有的金字塔和简单的插值，块和高质量的分开缓存
+        :return: numpy数组
+        """
+        if img is not self._img:
+            # 缓存的块引用着旧图像，换图时清掉，只在渲染线程中进行
+            self.tiles.clear()
+            self._img = img
+        sx = size[0] / ((crop[2] - crop[0]) * img.width)
+        sy = size[1] / ((crop[3] - crop[1]) * img.height)
+        # 从细节足够的最小一级金字塔取像素，换算到该级的坐标和比例
+        level = img.cached_level_for(min(sx, sy)) if fast else img.level_for(min(sx, sy))
+        fx, fy = level.width / img.width, level.height / img.height
+        origin = (crop[0] * img.width * fx, crop[1] * img.height * fy)
+        ratio = (sx / fx, sy / fy)
+        out = np.empty((view[3] - view[1], view[2] - view[0], 3), np.uint8)
+        for ty in range(view[1] // TILE_SIZE, math.ceil(view[3] / TILE_SIZE)):
+            for tx in range(view[0] // TILE_SIZE, math.ceil(view[2] / TILE_SIZE)):
+                key = (img, crop, size, tx, ty, fast)
+                tile = self.tiles.get(key)
+                if tile is None:
+                    tile = self._render_tile(level, origin, ratio, size, tx, ty, fast)
+                    self.tiles.put(key, tile, tile.nbytes)
+                left, top = tx * TILE_SIZE - view[0], ty * TILE_SIZE - view[1]
+                out[top:top + tile.shape[0], left:left + tile.shape[1]] = tile
+        return out
+
+    @staticmethod
+    def _render_tile(level: ImageLoader, origin, ratio, size, tx, ty, fast=False):
+        """
+        渲染一个块，每个输出像素按同一个仿射关系映射回源图像，块与块之间没有接缝
+        :param level: 金字塔中的一级
+        :param origin: 裁剪区域左上角在该级中的坐标
+        :param ratio: 相对于该级的缩放比例(x, y)
+        :param size: 缩放后图像的尺寸
+        :param tx: 块的列号
+        :param ty: 块的行号
+        :param fast: 放大两倍以上用最近邻，其它用线性插值
+        :return: numpy数组
+        """
+        left, top = tx * TILE_SIZE, ty * TILE_SIZE
+        width, height = min(TILE_SIZE, size[0] - left), min(TILE_SIZE, size[1] - top)
+        # 该块对应的源图像范围，多取两个像素给插值用
+        x0 = max(0, int(origin[0] + left / ratio[0]) - 2)
+        y0 = max(0, int(origin[1] + top / ratio[1]) - 2)
+        x1 = min(level.width, math.ceil(origin[0] + (left + width) / ratio[0]) + 2)
+        y1 = min(level.height, math.ceil(origin[1] + (top + height) / ratio[1]) + 2)
+        # 输出像素中心映射回源图像像素中心的坐标
+        m = np.float32([[1 / ratio[0], 0, origin[0] + (left + 0.5) / ratio[0] - 0.5 - x0],
+                        [0, 1 / ratio[1], origin[1] + (top + 0.5) / ratio[1] - 0.5 - y0]])
+        # 金字塔保证缩小不超过一半，用线性插值即可
+        if fast:
+            mode = cv2.INTER_NEAREST if min(ratio) >= 2 else cv2.INTER_LINEAR
+        else:
+            mode = cv2.INTER_CUBIC if min(ratio) >= 1 else cv2.INTER_LINEAR
+        return cv2.warpAffine(level.content[y0:y1, x0:x1], m, (width, height),
+                              flags=mode | cv2.WARP_INVERSE_MAP, borderMode=cv2.BORDER_REPLICATE)
+
+    def clear(self):
+        self.tiles.clear()
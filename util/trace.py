@@ -0,0 +1,168 @@
+import json
+import logging
+import os
+import threading
+import time
+from threading import Lock, local
+
+from pubsub import pub
+
+log = logging.getLogger('trace')
+log.setLevel(logging.ERROR)
+
+MAX_EVENTS = 1000000  # 最多记录的事件数，超出后不再记录，避免长时间运行占满内存
+
+_events = []
+_lock = Lock()
+_local = local()  # 各线程当前的关联id
+_threads = {}  # tid: 线程名
+_flows = set()  # 已经开始的关联id
+_path = None
+enabled = False
+
+
+def now():
+    # 微秒，Chrome trace的时间单位
+    return time.perf_counter_ns() // 1000
+
+
+def configure(path=None):
+    """
+    开启或关闭追踪，默认关闭，关闭时span几乎没有开销
+    :param path: 程序关闭时写入的Chrome trace JSON文件，可以用chrome://tracing或ui.perfetto.dev打开；None时关闭
+    :return:
+    """
+    global enabled, _path
+    _path = path
+    enabled = bool(path)
+    if enabled:
+        pub.subscribe(on_program_closed, 'program.closed')
+
+
+def set_context(cid):
+    """
+    设置当前线程后续span默认使用的关联id，一般是翻页时的浏览代数
+    :param cid:
+    :return:
+    """
+    _local.cid = cid
+
+
+def get_context():
+    return getattr(_local, 'cid', None)
+
+
+class Span(object):
+    """
+    记录一段耗时，结束时生成Chrome trace的完整事件(ph='X')
+    相同关联id的span之间用flow事件连接，可以跨线程看到一次翻页经过的各个阶段
+    """
+    __slots__ = ('name', 'cid', 'args', 'start')
+
+    def __init__(self, name, cid, args):
+        self.name = name
+        self.cid = cid
+        self.args = args
+        self.start = None
+
+    def __enter__(self):
+        self.start = now()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        complete(self.name, self.start, self.cid, **self.args)
+        return False
+
+
+class _NullSpan(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+_null_span = _NullSpan()
+
+
+def span(name, cid=None, **args):
+    """
+    with trace.span('cache.decode', req.generation, key=...):
+    :param name: 阶段名
+    :param cid: 关联id，None时使用当前线程的context
+    :param args: 附加在事件上的信息
+    :return: context manager
+    """
+    if not enabled:
+        return _null_span
+    return Span(name, cid if cid is not None else get_context(), args)
+
+
+def complete(name, start, cid=None, **args):
+    """
+    直接记录一段已经结束的耗时，例如请求在队列中等待的时间
+    :param name:
+    :param start: now()取得的开始时间
+    :param cid: 关联id，None时使用当前线程的context
+    :param args:
+    :return:
+    """
+    if not enabled:
+        return
+    end = now()
+    if cid is None:
+        cid = get_context()
+    tid = threading.get_ident()
+    event = {'name': name, 'ph': 'X', 'ts': start, 'dur': end - start, 'pid': os.getpid(), 'tid': tid,
+             'args': args}
+    if cid is not None:
+        args['cid'] = cid
+    with _lock:
+        if len(_events) >= MAX_EVENTS:
+            return
+        if tid not in _threads:
+            _threads[tid] = threading.current_thread().name
+        _events.append(event)
+        if cid is not None:
+            # flow事件绑定到同一时刻所在的span上
+            _events.append({'name': 'navigation', 'cat': 'flow', 'ph': 't' if cid in _flows else 's', 'id': cid,
+                            'ts': start, 'pid': event['pid'], 'tid': tid, 'bp': 'e'})
+            _flows.add(cid)
+
+
+def dump(path=None):
+    """
+    写出Chrome trace JSON
+    :param path: 默认为configure时给出的文件
+    :return: 写入的事件数
+    """
+    path = path or _path
+    if not path:
+        return 0
+    with _lock:
+        events = list(_events)
+        threads = dict(_threads)
+    pid = os.getpid()
+    meta = [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': name}}
+            for tid, name in threads.items()]
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': meta + events, 'displayTimeUnit': 'ms'}, f)
+    log.info('{} events written to {}'.format(len(events), path))
+    return len(events)
+
+
+def clear():
+    with _lock:
+        _events.clear()
+        _flows.clear()
+
+
+def on_program_closed(msg):
+    try:
+        dump()
+    except OSError as e:
+        log.error('trace not written: {}'.format(e))
@@ -0,0 +1,135 @@
+import logging
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from pathlib import Path
+from threading import Thread
+
+import wx
+from pubsub import pub
+
+from util.diskcache import cache_dir
+
+log = logging.getLogger('watchdog')
+log.setLevel(logging.ERROR)
+
+DEFAULT_THRESHOLD = 0.25  # 主线程超过多少秒没有响应算卡住
+DEFAULT_INTERVAL = 0.05  # 检查和采样的间隔
+MAX_SAMPLES = 200  # 一次卡住最多采样的次数
+STACK_LIMIT = 30  # 每个堆栈最多保留的层数
+
+
+class Watchdog(object):
+    """
+    在后台线程中定时通过wx.CallAfter询问主线程，超过阈值没有回应时，
+    用sys._current_frames()采样主线程的堆栈，恢复后把卡住的时长和采样到的堆栈写入日志文件
+    """
+
+    def __init__(self, threshold=DEFAULT_THRESHOLD, interval=DEFAULT_INTERVAL, path=None, call_after=None):
+        """
+        :param threshold: 秒
+        :param interval: 秒
+        :param path: 日志文件，默认为缓存目录下的stall.log
+        :param call_after: 把询问交给主线程的函数，默认wx.CallAfter
+        """
+        self.threshold = threshold
+        self.interval = interval
+        self.path = Path(path) if path is not None else cache_dir() / 'stall.log'
+        self.call_after = call_after if call_after is not None else wx.CallAfter
+        self.main_ident = threading.main_thread().ident
+        self.stopped = False
+        self.stalls = 0  # 记录的卡住次数
+        self._sent = None  # 尚未回应的询问发出的时间
+        self._answered = None  # 主线程回应的时间
+        self._samples = Counter()  # 这次卡住采样到的堆栈: 次数
+        self._first = None  # 第一次采样到的堆栈
+        self.thread = Thread(target=self.run, name='watchdog')
+        self.thread.daemon = True
+
+    def start(self):
+        pub.subscribe(self.on_program_closed, 'program.closed')
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped = True
+
+    def on_program_closed(self, msg):
+        self.stop()
+
+    def _pong(self, sent):
+        # 在主线程中执行，说明事件循环又开始处理消息了
+        if sent == self._sent:
+            self._answered = time.perf_counter()
+
+    def run(self):
+        while not self.stopped:
+            now = time.perf_counter()
+            if self._sent is None:
+                self._sent = now
+                self._answered = None
+                try:
+                    self.call_after(self._pong, now)
+                except Exception as e:  # wx.App已经退出
+                    log.error('watchdog stopped: {}'.format(e))
+                    return
+            elif self._answered is not None:
+                if self._samples:
+                    self._report(self._answered - self._sent)
+                self._sent = None
+                continue
+            elif now - self._sent >= self.threshold and sum(self._samples.values()) < MAX_SAMPLES:
+                self._sample()
+            time.sleep(self.interval)
+
+    def _sample(self):
+        frame = sys._current_frames().get(self.main_ident)
+        if frame is None:
+            return
+        stack = tuple(traceback.format_list(traceback.extract_stack(frame, STACK_LIMIT)))
+        if self._first is None:
+            self._first = stack
+        self._samples[stack] += 1
+
+    def _report(self, duration):
+        """
+        把一次卡住的信息写入日志，最常出现的堆栈就是耗时最多的地方
+        :param duration: 卡住的秒数
+        :return:
+        """
+        self.stalls += 1
+        total = sum(self._samples.values())
+        lines = ['{} main thread stalled for {:.3f}s, {} samples\n'.format(
+            time.strftime('%Y-%m-%d %H:%M:%S'), duration, total)]
+        for stack, count in self._samples.most_common(3):
+            lines.append('  {}/{} samples{}:\n'.format(count, total, ', first' if stack == self._first else ''))
+            lines.extend(stack)
+        lines.append('\n')
+        self._samples.clear()
+        self._first = None
+        try:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.writelines(lines)
+        except OSError as e:
+            log.error('stall not written to {}: {}'.format(self.path, e))
+
+
+def start(config):
+    """
+    按设置开启watchdog
+    :param config: None或False时不开启；数字为阈值（秒）；dict时为Watchdog的参数，例如{'threshold': 0.2, 'path': ...}
+    :return: Watchdog或None
+    """
+    if not config:
+        return None
+    if isinstance(config, dict):
+        watchdog = Watchdog(**config)
+    else:
+        watchdog = Watchdog(threshold=float(config))
+    try:
+        watchdog.path.parent.mkdir(parents=True, exist_ok=True)
+    except OSError as e:
+        log.error('cannot create {}: {}'.format(watchdog.path.parent, e))
+    return watchdog.start()
@@ -0,0 +1,200 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import sys
+import time
+from threading import Thread
+
+import wx
+
+log = logging.getLogger('watcher')
+log.setLevel(logging.ERROR)
+
+DEBOUNCE = 0.2  # 最后一个事件之后等待多少秒再通知，把连续的变化合并成一批
+MAX_DELAY = 1.  # 持续有变化时，最多等待多少秒就通知一次
+POLL_INTERVAL = 2.  # 不支持inotify时，每隔多少秒扫描一次目录
+
+# inotify的事件
+IN_MODIFY = 0x2
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+EVENT_HEADER = struct.Struct('iIII')  # wd, mask, cookie, len
+
+
+class Watcher(object):
+    """
+    监视一个目录中文件的增加、删除和修改，在后台线程中运行
+    变化合并成一批后，通过wx.CallAfter以callback(added, removed, modified)通知主线程，参数都是文件名的集合
+    """
+
+    def __init__(self, path, callback):
+        self.path = path
+        self.callback = callback
+        self.stopped = False
+        self.added = set()
+        self.removed = set()
+        self.modified = set()
+        self._first = None  # 这一批第一个事件的时间
+        self._last = None  # 最后一个事件的时间
+        self.thread = Thread(target=self.run, name='dir-watcher')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        # 线程在下一次超时时退出
+        self.stopped = True
+
+    def run(self):
+        raise NotImplementedError
+
+    def _record(self, added=(), removed=(), modified=()):
+        for name in added:
+            if name in self.removed:
+                # 删除后又出现，例如保存时先写临时文件再改名替换，看作修改
+                self.removed.discard(name)
+                self.modified.add(name)
+            else:
+                self.added.add(name)
+        for name in removed:
+            self.modified.discard(name)
+            if name in self.added:
+                # 这一批中新增的文件又被删除，例如临时文件，不用通知
+                self.added.discard(name)
+            else:
+                self.removed.add(name)
+        for name in modified:
+            if name not in self.added:
+                self.modified.add(name)
+        now = time.time()
+        if self._first is None:
+            self._first = now
+        self._last = now
+
+    def _flush(self, force=False):
+        # 安静了DEBOUNCE秒，或者这一批已经等了MAX_DELAY秒时通知
+        if self._first is None:
+            return
+        now = time.time()
+        if force or now - self._last >= DEBOUNCE or now - self._first >= MAX_DELAY:
+            if not self.stopped:
+                wx.CallAfter(self.callback, self.added, self.removed, self.modified)
+            self.added, self.removed, self.modified = set(), set(), set()
+            self._first = self._last = None
+
+
+class InotifyWatcher(Watcher):
+    """
+    linux下用inotify监视，通过ctypes调用libc，不需要额外的依赖
+    """
+
+    MASK = IN_CLOSE_WRITE | IN_MODIFY | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    def __init__(self, path, callback):
+        super(InotifyWatcher, self).__init__(path, callback)
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        wd = libc.inotify_add_watch(self.fd, os.fsencode(str(path)), self.MASK)
+        if wd < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), 'inotify_add_watch failed')
+
+    def run(self):
+        try:
+            while not self.stopped:
+                readable, _, _ = select.select([self.fd], [], [], DEBOUNCE)
+                if readable:
+                    self._parse(os.read(self.fd, 64 * 1024))
+                self._flush()
+        except OSError as e:
+            log.error('{}: {}'.format(self.path, e))
+        finally:
+            os.close(self.fd)
+
+    def _parse(self, data):
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            _, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & IN_ISDIR or not name:
+                continue
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                self._record(added=(name,))
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self._record(removed=(name,))
+            elif mask & (IN_CLOSE_WRITE | IN_MODIFY):
+                self._record(modified=(name,))
+
+
+class PollingWatcher(Watcher):
+    """
+    其它平台定时扫描目录，按大小和修改时间判断文件是否改变
+    """
+
+    def __init__(self, path, callback, interval=POLL_INTERVAL):
+        super(PollingWatcher, self).__init__(path, callback)
+        self.interval = interval
+        self.snapshot = None
+
+    def _scan(self):
+        snapshot = {}
+        with os.scandir(self.path) as it:
+            for entry in it:
+                try:
+                    if entry.is_file():
+                        st = entry.stat()
+                        snapshot[entry.name] = (st.st_size, st.st_mtime_ns)
+                except OSError:  # 扫描期间被删除
+                    pass
+        return snapshot
+
+    def run(self):
+        try:
+            self.snapshot = self._scan()
+            while not self.stopped:
+                time.sleep(self.interval)
+                if self.stopped:
+                    break
+                snapshot = self._scan()
+                old = self.snapshot
+                self._record(added=snapshot.keys() - old.keys(),
+                             removed=old.keys() - snapshot.keys(),
+                             modified=[name for name in snapshot.keys() & old.keys() if snapshot[name] != old[name]])
+                self.snapshot = snapshot
+                # 扫描间隔已经比DEBOUNCE长，直接通知
+                if self.added or self.removed or self.modified:
+                    self._flush(force=True)
+                else:
+                    self._first = self._last = None
+        except OSError as e:
+            log.error('{}: {}'.format(self.path, e))
+
+
+def watch(path, callback):
+    """
+    开始监视目录，linux下使用inotify，其它平台或inotify不可用时定时扫描
+    :param path: 目录
+    :param callback: callback(added, removed, modified)，在主线程中调用
+    :return: Watcher，不再需要时调用stop()
+    """
+    if sys.platform.startswith('linux'):
+        try:
+            return InotifyWatcher(path, callback).start()
+        except (OSError, AttributeError) as e:
+            log.info('inotify not available: {}'.format(e))
+    return PollingWatcher(path, callback).start()